@@ -0,0 +1,89 @@
+#!/usr/bin/env python2
+#
+# Usage: ./chart-relay.py [--port PORT] [--store FILE]
+#
+# Minimal stand-in for the chart relay, for testing. Set
+# chart_relay_upload to http://localhost:PORT/upload and
+# chart_relay_base to http://localhost:PORT/ in config.json.
+#
+# Uploads are POSTed as (optionally gzip-compressed) JSON of the form
+# {"charts": {ID: {"title": TITLE, "url": URL}}}; GET /ID redirects to
+# the chart URL.
+
+import argparse
+import gzip
+import json
+import logging
+import os.path
+import random
+import threading
+import BaseHTTPServer
+import SocketServer
+from StringIO import StringIO
+
+logging.basicConfig(
+    format='[%(asctime)s] %(levelname)s %(name)s: %(message)s',
+    level=logging.INFO
+)
+
+charts = {}
+charts_lock = threading.Lock()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="Address to listen on.")
+    parser.add_argument('--port', type=int, default=8081,
+                        help="Port to listen on.")
+    parser.add_argument('--store', metavar='FILE',
+                        help="Keep uploaded charts in the given JSON file.")
+    parser.add_argument('--fail-rate', type=float, default=0,
+                        help="Fraction of uploads to fail (to test retries).")
+    args = parser.parse_args()
+
+    if args.store and os.path.exists(args.store):
+        with open(args.store) as f:
+            charts.update(json.load(f))
+
+    class RelayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/upload':
+                return self.send_error(404)
+            if random.random() < args.fail_rate:
+                return self.send_error(503)
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.GzipFile(fileobj=StringIO(body)).read()
+            try:
+                upload = json.loads(body)['charts']
+            except (ValueError, KeyError):
+                return self.send_error(400)
+            with charts_lock:
+                charts.update(upload)
+                if args.store:
+                    with open(args.store, 'w') as f:
+                        json.dump(charts, f)
+            logging.info("Received %d charts (%d bytes)", len(upload),
+                         len(body))
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write('OK\n')
+
+        def do_GET(self):
+            with charts_lock:
+                chart = charts.get(self.path.lstrip('/'))
+            if not chart:
+                return self.send_error(404)
+            self.send_response(302)
+            self.send_header('Location', chart['url'])
+            self.end_headers()
+
+    class RelayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = RelayServer((args.host, args.port), RelayHandler)
+    logging.info("Relay listening on %s:%d", args.host, args.port)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,8 @@
 #!/usr/bin/env python2
 
+import time
+_START_TIME = time.time()
+
 # Add local lib directory (for praw)
 import sys
 import os.path
@@ -8,20 +11,24 @@ if os.path.exists(LIBDIR):
     sys.path.append(LIBDIR)
 
 import argparse
+import bisect
 import datetime
+import heapq
 import json
 import logging
+import random
 import re
 import sqlite3
-import time
+import struct
 import urllib
-import urllib2
-from HTMLParser import HTMLParser
-from collections import namedtuple
+import threading
+from collections import namedtuple, Counter, OrderedDict, deque
 
-import pytz
-import praw
-import prawcore
+# The network and timezone modules (praw, prawcore, pytz, urllib2 and
+# HTMLParser) are imported by the functions that use them, so that
+# local subcommands (plot, export, leaderboard) start quickly.
+
+_IMPORTED_TIME = time.time()
 
 # Initialize logging
 logging.basicConfig(
@@ -29,16 +36,196 @@ logging.basicConfig(
     level=logging.INFO
 )
 
-# Load configuration
-with open('config.json') as f:
-    CONFIG = json.load(f)
-CONFIG['anonymize'] = set(x.lower() for x in CONFIG.get('anonymize', []))
-
-# Open database
-db = sqlite3.connect(CONFIG["dbfile"])
-c = db.cursor()
-
-USER_AGENT = CONFIG["user_agent"]
+# Configuration, loaded on first use
+CONFIG = None
+def get_config():
+    global CONFIG
+    if CONFIG is None:
+        with open('config.json') as f:
+            CONFIG = json.load(f)
+        CONFIG['anonymize'] = set(x.lower()
+                                  for x in CONFIG.get('anonymize', []))
+    return CONFIG
+
+# Tables added after the original schema (schema.txt), created when the
+# database is opened so that existing databases keep working
+SCHEMA_UPGRADES = [
+    # Peak number of circles joined by each user (see backfill-peaks)
+    'CREATE TABLE IF NOT EXISTS peak(author UNIQUE NOT NULL COLLATE NOCASE, ' +
+    'following, time)',
+    # Charts uploaded to the chart relay
+    'CREATE TABLE IF NOT EXISTS relay(id PRIMARY KEY, uploaded)',
+    # Jobs shared by daemons (see WorkQueue)
+    'CREATE TABLE IF NOT EXISTS work(job PRIMARY KEY, kind, arg, priority, ' +
+    'available, owner, expires)',
+    # Published leaderboards (see archive_leaderboard)
+    'CREATE TABLE IF NOT EXISTS archive(seq INTEGER PRIMARY KEY, time, ' +
+    'postid, keyframe, data)',
+    # Newest post or comment seen from each user (see observe_seen)
+    'CREATE TABLE IF NOT EXISTS lastseen(author UNIQUE NOT NULL ' +
+    'COLLATE NOCASE, thing, created, seen, flair)',
+    # Integer IDs of authors, used by the user table (see author_id)
+    'CREATE TABLE IF NOT EXISTS author(id INTEGER PRIMARY KEY, ' +
+    'name UNIQUE NOT NULL COLLATE NOCASE)',
+    # Changes not yet written to the change feed (see publish_changes)
+    'CREATE TABLE IF NOT EXISTS changes(seq INTEGER PRIMARY KEY ' +
+    'AUTOINCREMENT, data)',
+    # Recent observations, for seeding VelocityTracker
+    'CREATE INDEX IF NOT EXISTS by_time ON user(time)',
+]
+
+# Database, opened by main() for subcommands that need it
+db = None
+c = None
+def open_db():
+    global db, c
+    if db is None:
+        db = sqlite3.connect(get_config()["dbfile"])
+        c = db.cursor()
+        for statement in SCHEMA_UPGRADES:
+            c.execute(statement)
+        migrate_author_ids()
+    return db
+
+def _user_has_names():
+    c.execute('PRAGMA table_info(user)')
+    return 'author' in [row[1] for row in c.fetchall()]
+
+def migrate_author_ids():
+    """Replace the author names in the user table of databases created
+    before the author table with integer IDs, keeping the rowids."""
+    if not _user_has_names():
+        return
+    # Manage the transaction here, since the sqlite3 module commits
+    # before schema changes
+    db.isolation_level = None
+    try:
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            if not _user_has_names():
+                # Another process got here first
+                c.execute('ROLLBACK')
+                return
+            logging.info("Migrating the user table to author IDs...")
+            c.execute('INSERT OR IGNORE INTO author(name) ' +
+                      'SELECT author FROM user ORDER BY rowid ASC')
+            c.execute('CREATE TABLE user_new(time, authorid INTEGER ' +
+                      'NOT NULL, followers, following, betrayer)')
+            c.execute('INSERT INTO user_new(rowid, time, authorid, ' +
+                      'followers, following, betrayer) ' +
+                      'SELECT user.rowid, time, author.id, followers, ' +
+                      'following, betrayer FROM user ' +
+                      'INNER JOIN author ON author.name == user.author')
+            c.execute('DROP TABLE user')
+            c.execute('ALTER TABLE user_new RENAME TO user')
+            c.execute('CREATE INDEX by_author ON user(authorid)')
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+    finally:
+        db.isolation_level = ''
+    c.execute('SELECT count(*) FROM author')
+    logging.info("Migrated %d authors; VACUUM the database to reclaim the " +
+                 "space", c.fetchone()[0])
+
+# Author IDs by lowercase name (see author_id)
+_author_ids = {}
+
+def author_id(author, create=True):
+    """Return the integer ID of an author, adding them to the author
+    table if needed (or returning None if not, unless create is set)."""
+    key = author.lower()
+    authorid = _author_ids.get(key)
+    if authorid is None:
+        c.execute('SELECT id FROM author WHERE name=?', (author,))
+        row = c.fetchone()
+        if row:
+            authorid = row[0]
+        elif not create:
+            return None
+        else:
+            # Another process may add the same name between the statements
+            c.execute('INSERT OR IGNORE INTO author(name) VALUES(?)',
+                      (author,))
+            c.execute('SELECT id FROM author WHERE name=?', (author,))
+            authorid = c.fetchone()[0]
+        _author_ids[key] = authorid
+    return authorid
+
+# SQL tracing (see --profile): statements taking longer than this many
+# seconds, including fetching their results, get their query plan shown
+SLOW_QUERY = 0.05
+
+class TracingCursor(object):
+    """Wrap a cursor to time each statement, including fetching its
+    results."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.stats = {}         # SQL -> [count, total, slowest, params]
+        self.current = None
+
+    def _finish(self):
+        if self.current:
+            sql, params, elapsed = self.current
+            stats = self.stats.setdefault(sql, [0, 0, 0, None])
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed >= stats[2]:
+                stats[2:] = [elapsed, params]
+            self.current = None
+
+    def _timed(self, func, *args):
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            if self.current:
+                self.current[2] += time.time() - start
+
+    def execute(self, sql, params=()):
+        self._finish()
+        self.current = [sql, params, 0]
+        self._timed(self.cursor.execute, sql, params)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._finish()
+        self.current = [sql, None, 0]
+        self._timed(self.cursor.executemany, sql, seq_of_params)
+        return self
+
+    def fetchone(self):
+        return self._timed(self.cursor.fetchone)
+
+    def fetchall(self):
+        return self._timed(self.cursor.fetchall)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self._timed(self.cursor.next)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def report(self, out, threshold=SLOW_QUERY):
+        self._finish()
+        stats = sorted(self.stats.items(), key=lambda x: -x[1][1])
+        print >>out, "%d SQL statements in %.3f seconds" % (
+            sum(x[0] for sql, x in stats), sum(x[1] for sql, x in stats))
+        print >>out, "   calls    total  slowest  statement"
+        for sql, (count, total, slowest, params) in stats:
+            print >>out, "%8d %8.3f %8.3f  %s" % (
+                count, total, slowest, ' '.join(sql.split()))
+            if slowest < threshold or params is None:
+                continue
+            plan = self.cursor.connection.execute(
+                'EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+            for row in plan:
+                print >>out, "%28s %s" % ('', row[-1])
 
 CIRCLE_RESET_TIME = 1522686780  # 2 April 2018 09:33 PDT
 CIRCLE_EARLIEST_TIME = 1522674000   # 2 April 2018 06:00:00 PDT
@@ -63,10 +250,12 @@ PLOT_HEIGHT = 175
 SUBREDDIT = 'CircleofTrust'     # Circle subreddit
 SAFE_CIRCLE = 'nandhp'          # Known existing circle
 DEFAULT_STALENESS = 30*60       # Default staleness for daemon audits
+VELOCITY_WINDOW = 3*ONE_HOUR    # Period over which growth is ranked
+VELOCITY_BUCKETS = 12           # Samples kept per user over that period
+GROWING_LENGTH = 10             # Rows in the fastest growing board
 
 REDDIT_GAP = 1                  # Minimum seconds between API requests
-AUDIT_INTERVAL = REDDIT_GAP # 4
-AUDIT_INTERVAL_DIVISIONS = 1
+DAEMON_AUDIT_BATCH = 25         # Users audited together per daemon iteration
 FASTEST_POSSIBLE = False
 
 # &#x2205; (betray, empty set), &#x2300; (diameter), &#xd8; (O with stroke)
@@ -77,6 +266,9 @@ JOIN_SYMBOL = '&#9737;' #'&#x2609;'
 
 # +&#x20dd; (combining enclosing circle), &#x25f5; (bottom-left) &#x238a; (circled triangle down)
 USERS_SYMBOL = '&#9098;' #'&#x238a;';
+
+# &#x2197; (north east arrow)
+GROWING_SYMBOL = '&#8599;' #'&#x2197;'
 # http://shapecatcher.com/
 
 ######################################################################
@@ -131,6 +323,13 @@ def observe_circle(postid, author, title, created, betrayed, audited=None):
             c.execute('UPDATE circle SET betrayed=? WHERE id=?',
                       (betrayed, postid))
             n = 1
+    if n and _rankings:
+        _rankings.reload_circle(postid, author)
+    if n:
+        if postid:
+            stage_circle_change('id', postid)
+        else:
+            stage_circle_change('author', author)
     return n
 
 def observe_missing_circle(author, betrayed=None, audited=None):
@@ -155,6 +354,10 @@ def observe_missing_circle(author, betrayed=None, audited=None):
             c.execute('UPDATE circle SET betrayed=? WHERE author=?',
                       (betrayed, row[0]))
             n = 1
+    if n and _rankings:
+        _rankings.reload_circle(None, author)
+    if n:
+        stage_circle_change('author', author)
     return n
 
 def observe_circle_post(post, now=None):
@@ -170,12 +373,13 @@ def observe_circle_post(post, now=None):
                           post.title, post.created_utc, betrayed)
 
 def observe_user(now, author, stats):
+    authorid = author_id(author)
     # Check nearest sample in each direction
     for clause in 'time<=? ORDER BY time DESC', 'time>? ORDER BY time ASC':
         # Also order by rowid (newest first) for tie-breaking
         c.execute(('SELECT followers, following, betrayer, time FROM user ' +
-                   'WHERE author=? AND %s, rowid DESC LIMIT 1') % (clause,),
-                  (author, now))
+                   'WHERE authorid=? AND %s, rowid DESC LIMIT 1') % (clause,),
+                  (authorid, now))
         for row in c.fetchall():
             # Skip adding this observation if there is a matching neighbor
             obsnow = row[-1]
@@ -191,11 +395,33 @@ def observe_user(now, author, stats):
 
     # Store observation
     c.execute('INSERT INTO user' +
-              '(time, author, followers, following, betrayer) ' +
+              '(time, authorid, followers, following, betrayer) ' +
               'VALUES(?, ?, ?, ?, ?)',
-              (now, author, stats.followers, stats.following, stats.betrayer))
+              (now, authorid, stats.followers, stats.following,
+               stats.betrayer))
+    if stats.following is not None:
+        observe_peak(now, author, stats.following)
+    if _rankings:
+        _rankings.observe_user(now, author, stats)
+    if _velocity:
+        _velocity.observe(now, author, stats)
+    stage_change({'table': 'user', 'time': now, 'author': author,
+                  'followers': stats.followers, 'following': stats.following,
+                  'betrayer': stats.betrayer})
     return 1
 
+def observe_peak(now, author, following):
+    # Keep the earliest time the highest value was reached
+    c.execute('INSERT OR IGNORE INTO peak(author, following, time) ' +
+              'VALUES(?, ?, ?)', (author, following, now))
+    if c.rowcount < 1:
+        c.execute('UPDATE peak SET following=?, time=? WHERE author=? AND ' +
+                  '(following IS NULL OR following < ? OR ' +
+                  ' (following == ? AND time > ?))',
+                  (following, now, author, following, following, now))
+    if _rankings:
+        _rankings.observe_peak(author, following)
+
 def observe_user_post(thing, now=None, baseline=None):
     if now is None:
         now = time.time()
@@ -211,33 +437,364 @@ def observe_user_post(thing, now=None, baseline=None):
 
     return observe_user(now, thing.author.name, stats)
 
+def observe_seen(thing, now=None):
+    """Remember a user's newest post or comment in the subreddit, so that
+    audits can look it up instead of searching their history."""
+    if not thing.author:
+        return
+    if now is None:
+        now = time.time()
+    c.execute('INSERT OR IGNORE INTO lastseen(author, thing, created, seen, ' +
+              'flair) VALUES(?, ?, ?, ?, ?)',
+              (thing.author.name, thing.fullname, thing.created_utc, now,
+               thing.author_flair_text))
+    if c.rowcount < 1:
+        c.execute('UPDATE lastseen SET thing=?, created=?, seen=?, flair=? ' +
+                  'WHERE author=? AND created <= ?',
+                  (thing.fullname, thing.created_utc, now,
+                   thing.author_flair_text, thing.author.name,
+                   thing.created_utc))
+
+def get_last_seen(author):
+    """Return the fullname of a user's newest post or comment seen."""
+    c.execute('SELECT thing FROM lastseen WHERE author=?', (author,))
+    row = c.fetchone()
+    return row[0] if row else None
+
 ######################################################################
 # OBSERVE/INGEST SUBCOMMANDS
 ######################################################################
 
-_reddit = None
+REDDIT_URL = 'https://www.reddit.com'   # Overridden by reddit_url in config
+REDDIT_RATE = 60                # Requests per minute for each credential
+REDDIT_PAGE = 100               # Items per listing request
+EMBED_RATE = 60/REDDIT_GAP      # Requests per minute for embed.json
+
+# Share of each rate limit window held back from each kind of work for
+# higher-priority work (edits first, then the comment stream, audits and
+# listing observations), so that lower priorities slow down first as
+# the budget runs out
+BUDGET_RESERVE = {
+    'edit': 0,
+    'comments': .05,
+    'audit': .15,
+    'observe': .3,
+}
+
+class RateLimiter(object):
+    """Pace requests to a given rate, allowing short bursts."""
+
+    def __init__(self, per_minute, burst=1):
+        self.interval = 60./per_minute
+        self.burst = burst
+        self.next_time = 0
+
+    def delay(self):
+        """Seconds until the next request may be made."""
+        return max(0, self.next_time - time.time())
+
+    def take(self, cost=1):
+        earliest = time.time() - (self.burst-1)*self.interval
+        self.next_time = max(self.next_time, earliest) + cost*self.interval
+
+class RequestBudget(object):
+    """The requests left in the current rate limit window, as given by
+    the X-Ratelimit-* headers of the latest response, spread over the
+    rest of the window by priority. A fixed rate is used until the first
+    response."""
+
+    def __init__(self, per_minute):
+        self.limiter = RateLimiter(per_minute)
+        self.remaining = None
+        self.used = None
+        self.reset_time = None
+        self.last_time = 0      # Time and cost of the last request granted
+        self.last_cost = 0
+        self.granted = 0        # Requests left of the last grant
+        self.ungranted = 0
+
+    def known(self):
+        return self.reset_time is not None and time.time() < self.reset_time
+
+    def delay(self, kind, cost=1):
+        """Seconds until cost requests of the given kind may be made."""
+        now = time.time()
+        if not self.known():
+            return self.limiter.delay()
+        window = self.remaining + self.used
+        spendable = self.remaining - BUDGET_RESERVE.get(kind, 0)*window
+        if spendable < cost:
+            # Wait for the next window
+            return self.reset_time - now
+        interval = (self.reset_time - now)/spendable
+        return max(0, self.last_time + self.last_cost*interval - now)
+
+    def take(self, cost=1):
+        self.limiter.take(cost)
+        self.last_time = time.time()
+        self.last_cost = cost
+        self.granted = cost
+
+    def update(self, headers):
+        """Record the rate limit headers of a response."""
+        if 'x-ratelimit-remaining' not in headers:
+            if self.known():
+                self.remaining -= 1
+                self.used += 1
+            return
+        self.remaining = float(headers['x-ratelimit-remaining'])
+        self.used = int(float(headers['x-ratelimit-used']))
+        self.reset_time = time.time() + int(headers['x-ratelimit-reset'])
+
+    def call(self, request_function, set_header_callback, *args, **kwargs):
+        """Make a request for praw, in place of prawcore's rate limiter
+        (which would spread requests evenly regardless of priority)."""
+        if self.granted < 1:
+            # Not acquired through the dispatcher, as with the requests
+            # made by praw's comment stream, so paced as comments
+            delay = self.delay('comments')
+            if delay and not FASTEST_POSSIBLE:
+                time.sleep(delay)
+            self.take()
+            self.ungranted += 1
+        self.granted -= 1
+        kwargs['headers'] = set_header_callback()
+        response = request_function(*args, **kwargs)
+        self.update(response.headers)
+        return response
+
+    def describe(self):
+        if not self.known():
+            return 'no rate limit seen'
+        return '%d left for %ds, %d ungranted' % (
+            self.remaining, self.reset_time - time.time(), self.ungranted)
+
+class RedditClient(object):
+    """One set of Reddit credentials, with its own praw instance, request
+    budget and statistics."""
+
+    def __init__(self, name, credentials):
+        self.name = name
+        self.credentials = credentials
+        self.budget = RequestBudget(credentials.get('rate', REDDIT_RATE))
+        self.stats = Counter()
+        self._reddit = None
+
+    @property
+    def reddit(self):
+        if not self._reddit:
+            import praw
+            config = get_config()
+            # Site URLs can be overridden to point at a stand-in API
+            sites = dict((k, config[k]) for k in ('oauth_url', 'reddit_url')
+                         if config.get(k))
+            self._reddit = praw.Reddit(
+                user_agent=config["user_agent"],
+                client_id=self.credentials["client_id"],
+                client_secret=self.credentials["client_secret"],
+                username=self.credentials['username'],
+                password=self.credentials['password'], **sites)
+            # All of praw's requests report their rate limit headers.
+            # praw switches between an authorized and a read-only session,
+            # each with its own limiter (private attributes of praw 5.x)
+            for core in (self._reddit._authorized_core,
+                         self._reddit._read_only_core):
+                if core is not None:
+                    core._rate_limiter = self.budget
+        return self._reddit
+
+class RedditDispatcher(object):
+    """Assign each unit of API work to the client with the most free
+    budget for its kind of work. Every request to Reddit waits here."""
+
+    def __init__(self, clients):
+        self.clients = clients
+        # embed.json is fetched without credentials
+        self.embed = RequestBudget(EMBED_RATE)
+        self.embed_stats = Counter()
+
+    def delay(self, kind, cost=1):
+        """Seconds until some client has budget for the given work."""
+        return min(x.budget.delay(kind, cost) for x in self.clients)
+
+    def acquire(self, kind, cost=1, client=None):
+        """Wait until a client (or the given client) has budget for cost
+        requests of the given kind of work, and return it."""
+        if client is None:
+            # Prefer the least-used client when several are free
+            client = min(self.clients, key=lambda x: (
+                x.budget.delay(kind, cost), x.stats['requests']))
+        delay = client.budget.delay(kind, cost)
+        if delay and not FASTEST_POSSIBLE:
+            time.sleep(delay)
+            client.stats['waited'] += delay
+        client.budget.take(cost)
+        client.stats[kind] += 1
+        client.stats['requests'] += cost
+        return client
+
+    def acquire_embed(self):
+        """Wait until an embed.json request may be made, and return the
+        budget to update with its response headers."""
+        delay = self.embed.delay('embed')
+        if delay and not FASTEST_POSSIBLE:
+            time.sleep(delay)
+            self.embed_stats['waited'] += delay
+        self.embed.take()
+        self.embed_stats['requests'] += 1
+        return self.embed
+
+    def log_stats(self):
+        for client in self.clients:
+            logging.info("Credential %s: %s (%s)", client.name, ', '.join(
+                '%s %d' % x for x in sorted(client.stats.items())),
+                client.budget.describe())
+        logging.info("Embed: %s (%s)", ', '.join(
+            '%s %d' % x for x in sorted(self.embed_stats.items())),
+            self.embed.describe())
+
+_dispatcher = None
+def get_dispatcher():
+    global _dispatcher
+    if not _dispatcher:
+        config = get_config()
+        # The first (or only) account is the one that owns the post
+        accounts = config.get('accounts') or [config]
+        _dispatcher = RedditDispatcher([
+            RedditClient(x['username'], x) for x in accounts
+        ])
+    return _dispatcher
+
 def get_reddit():
-    global _reddit
-    if not _reddit:
-        _reddit = praw.Reddit(user_agent=USER_AGENT,
-                              client_id=CONFIG["client_id"],
-                              client_secret=CONFIG["client_secret"],
-                              username=CONFIG['username'],
-                              password=CONFIG['password'])
-    return _reddit
+    return get_dispatcher().clients[0].reddit
 
 def get_subreddit(reddit=None):
     if not reddit:
         reddit = get_reddit()
     return reddit.subreddit(SUBREDDIT)
 
+# Failed requests are retried with jittered exponential backoff. Each
+# class of endpoint has a circuit breaker, so that a failing endpoint is
+# paused while work on the others continues.
+RETRY_ATTEMPTS = 4              # Attempts per request
+RETRY_BASE = 2                  # Seconds before the first retry
+RETRY_MAX = 30                  # Maximum seconds between retries
+BREAKER_THRESHOLD = 5           # Consecutive failures to open a breaker
+BREAKER_COOLDOWN = 60           # Seconds before an open breaker is retried
+BREAKER_MAX_COOLDOWN = 15*60    # Limit for repeated cooldowns
+
+class CircuitOpen(Exception):
+    """A request was skipped because its endpoint's breaker is open."""
+
+class CircuitBreaker(object):
+    """Stop requests to an endpoint after repeated failures, allowing a
+    single trial request after each cooldown."""
+
+    def __init__(self, name):
+        self.name = name
+        self.state = 'closed'
+        self.failures = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self.opened = 0
+        self.stats = Counter()
+
+    def _set_state(self, state):
+        if state != self.state:
+            logging.warning("Circuit %s is now %s (was %s)", self.name,
+                            state, self.state)
+            self.state = state
+            self.stats[state] += 1
+
+    def check(self):
+        if self.state == 'open':
+            remaining = self.opened + self.cooldown - time.time()
+            if remaining > 0:
+                self.stats['skipped'] += 1
+                raise CircuitOpen("%s paused for %d more seconds" %
+                                  (self.name, remaining))
+            self._set_state('half-open')
+
+    def success(self):
+        self.failures = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self._set_state('closed')
+
+    def failure(self):
+        self.failures += 1
+        self.stats['failures'] += 1
+        if self.state == 'half-open':
+            # The trial request failed: wait longer next time
+            self.cooldown = min(self.cooldown*2, BREAKER_MAX_COOLDOWN)
+        elif self.failures < BREAKER_THRESHOLD:
+            return
+        self.opened = time.time()
+        self._set_state('open')
+
+_breakers = OrderedDict()
+def get_breaker(endpoint):
+    if endpoint not in _breakers:
+        _breakers[endpoint] = CircuitBreaker(endpoint)
+    return _breakers[endpoint]
+
+def log_breakers():
+    for breaker in _breakers.values():
+        logging.info("Circuit %s: %s%s", breaker.name, breaker.state, ''.join(
+            ', %s %d' % x for x in sorted(breaker.stats.items())))
+
+def is_transient(exc):
+    """Whether a failed request is worth retrying."""
+    import socket
+    import urllib2
+    import prawcore
+    if isinstance(exc, urllib2.HTTPError):
+        return exc.code == 429 or exc.code >= 500
+    if isinstance(exc, (urllib2.URLError, socket.error)):
+        return True
+    if isinstance(exc, (prawcore.exceptions.ServerError,
+                        prawcore.exceptions.RequestException)):
+        return True
+    if isinstance(exc, prawcore.exceptions.ResponseException):
+        return exc.response.status_code == 429
+    return False
+
+def call_with_retry(endpoint, func, *args, **kwargs):
+    """Call func, retrying transient failures, through the circuit
+    breaker for the given class of endpoint (embed, listings, comments
+    or edit)."""
+    breaker = get_breaker(endpoint)
+    for attempt in range(RETRY_ATTEMPTS):
+        breaker.check()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as exc:
+            if not is_transient(exc):
+                # The endpoint answered, so it is working
+                breaker.success()
+                raise
+            breaker.failure()
+            if attempt == RETRY_ATTEMPTS-1 or breaker.state == 'open':
+                raise
+            delay = random.uniform(0, min(RETRY_MAX, RETRY_BASE*2**attempt))
+            logging.warning("Retrying %s in %.1f seconds after %s: %s",
+                            endpoint, delay, type(exc).__name__, exc)
+            breaker.stats['retries'] += 1
+            time.sleep(delay)
+        else:
+            breaker.success()
+            return result
+
 def run_daemon(args):
     """Daemon mode to continuously monitor circles and users, and
     (optionally) regularly update the leaderboard.
     """
 
+    if args.queue:
+        return run_queue_daemon(args)
+
     observation_cycle_len = 10
     iteration = int(time.time()/60) % observation_cycle_len
+    enable_rankings()
+    enable_velocity()
     comment_stream = do_observe_comments(args, pause_after=0)
     comment_stream.next()
 
@@ -259,48 +816,44 @@ def run_daemon(args):
                     do_observe(args, '/top/day')
                 else:               # 1,7
                     do_observe(args, '/top')
+            except CircuitOpen as e:
+                logging.warning("Skipping observe: %s", e)
             except Exception as e:
                 logging.exception(e)
-                logging.warn("Sleeping due to exception in observe")
-                time.sleep(60)
 
-        audittimes = min(4, 60/AUDIT_INTERVAL-1)
-        auditdelay = AUDIT_INTERVAL/AUDIT_INTERVAL_DIVISIONS
         if iteration in (0, 2, 4, 6, 8):
             auditquery = -1     # Top users
         else:                   # 1,3,5,7,9
             auditquery = 0      # Top circles
         try:
-            for i in range(audittimes):
-                do_audit(args, auditquery, DEFAULT_STALENESS,
-                         args.audit_density,
-                         sleep=0 if args.audit_density == 1 else -1)
-                for i in range(AUDIT_INTERVAL_DIVISIONS):
-                    next_audit = time.time() + auditdelay
-                    comment_stream.send(next_audit-1)
-                    # Sleep at least two seconds before next audit
-                    if not FASTEST_POSSIBLE:
-                        time.sleep(max(next_audit-time.time(), REDDIT_GAP))
+            # Follow the comments between audits, until there is budget
+            # to audit again
+            do_audit(args, auditquery, DEFAULT_STALENESS, args.audit_batch,
+                     pause=lambda: comment_stream.send(
+                         time.time() + get_dispatcher().delay('audit')),
+                     pause_every=args.audit_density)
         except Exception as e:
             logging.exception(e)
-            logging.warn("Sleeping due to exception in audit")
-            time.sleep(60)
 
         # Update leaderboard
         if args.update:
             logging.info("Running leaderboard update")
             try:
-                do_leaderboard(args.update)
+                do_leaderboard(args.update, dry_run=args.dry_run)
+            except CircuitOpen as e:
+                logging.warning("Skipping leaderboard update: %s", e)
             except Exception as e:
                 logging.exception(e)
-                logging.warn("Sleeping due to exception in leaderboard")
-                time.sleep(60)
         else:
             logging.info("Skipping leaderboard update")
 
         # Next iteration
         logging.info('---- Iteration took %d seconds ----',
                      time.time() - iteration_start)
+        get_dispatcher().log_stats()
+        log_breakers()
+        if iteration == 0:
+            check_rankings()
         iteration = (iteration+1) % observation_cycle_len
 
 def save(args, count):
@@ -309,33 +862,50 @@ def save(args, count):
     else:
         db.commit()
         logging.info("Updated %d entries", count)
+        publish_changes()
+
+# Posts seen in listings, with the fields we store, so that unchanged
+# posts can be skipped on the next scan (least recently seen dropped first)
+OBSERVE_CACHE_SIZE = 5000
+_post_fingerprints = OrderedDict()
+
+def post_fingerprint(post):
+    return (post.title, post.author.name if post.author else None, post.url,
+            post.created_utc, post.link_flair_text, post.author_flair_text)
 
 def do_observe(args, query, do_save=False):
-    sr = get_subreddit()
+    if not query:
+        query = '/top'
+    listing = query
+    limit = 200 if query.startswith('/') else 500
+    client = get_dispatcher().acquire('observe',
+                                      cost=(limit+REDDIT_PAGE-1)//REDDIT_PAGE)
+    sr = get_subreddit(client.reddit)
 
     now = time.time()
     if do_save:
         print time.time()
         print
 
-    if not query:
-        query = '/top'
     logging.info("Observing query %s", query)
     if query == '/top/day':
-        query = sr.top('day', limit=200)
+        fetch = lambda: sr.top('day', limit=200)
     elif query == '/top' or query == '/top/all':
-        query = sr.top('all', limit=200)
+        fetch = lambda: sr.top('all', limit=200)
     elif query == '/hot':
-        query = sr.hot(limit=200)
+        fetch = lambda: sr.hot(limit=200)
     elif query == '/new':
-        query = sr.new(limit=200)
+        fetch = lambda: sr.new(limit=200)
     elif query == '/rising':
-        query = sr.rising(limit=200)
+        fetch = lambda: sr.rising(limit=200)
     else:
-        query = sr.search(query, sort='top', limit=500)
+        fetch = lambda: sr.search(query, sort='top', limit=500)
 
-    count = 0
-    for post in query:
+    count, seen, skipped = 0, 0, 0
+    # Each attempt starts a new listing, since a failed one is partly
+    # consumed
+    for post in call_with_retry('listings', lambda: list(fetch())):
+        seen += 1
         if do_save:
             print post.author, post.id, post.created_utc
             print post.title.encode('utf-8')
@@ -344,20 +914,35 @@ def do_observe(args, query, do_save=False):
             print
             count += 1
         else:
+            fingerprint = post_fingerprint(post)
+            if _post_fingerprints.pop(post.id, None) == fingerprint:
+                _post_fingerprints[post.id] = fingerprint
+                skipped += 1
+                continue
             n = 0
             n += observe_circle_post(post, now)
             n += observe_user_post(post, now)
             if n > 0:
                 count += 1
+            observe_seen(post, now)
+            _post_fingerprints[post.id] = fingerprint
+            if len(_post_fingerprints) > OBSERVE_CACHE_SIZE:
+                _post_fingerprints.popitem(last=False)
+    if not do_save:
+        logging.info("Skipped %d of %d posts in %s as unchanged (%d%%)",
+                     skipped, seen, listing, 100*skipped/max(seen, 1))
     save(args, count)
 
 def run_observe(args):
     """Observe circles (posts) matching given listing or search query."""
 
-    return do_observe(args, args.query, do_save=args.save)
+    result = do_observe(args, args.query, do_save=args.save)
+    get_dispatcher().log_stats()
+    return result
 
 def do_observe_comments(args, pause_after=None):
-    sr = get_subreddit()
+    # The stream stays with the client it starts on
+    sr = get_subreddit(get_dispatcher().acquire('comments').reddit)
     stream = sr.stream.comments(pause_after=pause_after)
     deadline = 0 if pause_after is not None else None
 
@@ -366,13 +951,15 @@ def do_observe_comments(args, pause_after=None):
         if comment.author and comment.author.name:
             n += observe_missing_circle(comment.author.name, None)
         n += observe_user_post(comment, now, baseline=5)
+        observe_seen(comment, now)
         return 1 if n > 0 else 0
 
     # Fetch 200 comments to start us off
     logging.info("Initializing comment stream")
     now = time.time()
     seen, count = 0, 0
-    for comment in sr.comments(limit=200):
+    for comment in call_with_retry('comments',
+                                   lambda: list(sr.comments(limit=200))):
         seen += 1
         count += _handle_comment(comment, now)
     logging.info("Seen %d comments (initialization)", seen)
@@ -387,13 +974,33 @@ def do_observe_comments(args, pause_after=None):
 
         now = time.time()
 
+        breaker = get_breaker('comments')
+        try:
+            breaker.check()
+        except CircuitOpen as e:
+            logging.warning("Skipping comments: %s", e)
+            if deadline is None:
+                time.sleep(BREAKER_COOLDOWN)
+            continue
+
         logging.info("Observing comments")
         seen, count, iters = 0, 0, 0
         comment = True
         # Observe comments until we run out of data or hit the deadline
         while comment and (deadline is None or now < deadline or iters == 0):
             for _ in range(100):
-                comment = stream.next()
+                try:
+                    comment = stream.next()
+                except Exception as exc:
+                    if not is_transient(exc):
+                        raise
+                    logging.warning("Comment stream failed: %s", exc)
+                    breaker.failure()
+                    # The stream cannot be resumed after an exception
+                    stream = sr.stream.comments(pause_after=pause_after)
+                    comment = None
+                    break
+                breaker.success()
                 if not comment:
                     break
                 seen += 1
@@ -415,6 +1022,7 @@ def run_observe_comments(args):
     do_observe_comments(args, pause_after=None).next()
 
 def find_user_comment(username, reddit=None, limit=200):
+    import prawcore
     if not reddit:
         reddit = get_reddit()
     user = reddit.redditor(username)
@@ -481,9 +1089,19 @@ CIRCLE_TITLE_RE = re.compile(r'<div class="[^"]*circle-title[^"]*"><a href=' +
                              r'"/r/[^/"]+/comments/([0-9a-zA-Z]+)/[^/"]*/">' +
                              r'([^<>]*)</a></div>')
 def get_circle(username):
-    url = 'https://www.reddit.com/user/%s/circle/embed.json' % (username,)
-    req = urllib2.Request(url, headers={'User-Agent': USER_AGENT})
-    resp = urllib2.urlopen(req)
+    import urllib2
+    from HTMLParser import HTMLParser
+    url = '%s/user/%s/circle/embed.json' % (
+        get_config().get('reddit_url') or REDDIT_URL, username)
+    req = urllib2.Request(url, headers={'User-Agent':
+                                        get_config()["user_agent"]})
+    budget = get_dispatcher().acquire_embed()
+    try:
+        resp = urllib2.urlopen(req)
+    except urllib2.HTTPError as exc:
+        budget.update(exc.info())
+        raise
+    budget.update(resp.info())
     #print resp.code
     #print resp.headers
     data = resp.read()
@@ -497,18 +1115,42 @@ def get_circle(username):
     obj['x_username'] = CIRCLE_USERNAME_RE.search(data).group(1)
     return obj
 
-def refresh_circle(username, dry_run=False, verbose=False):
+def fetch_submission(reddit, **kwargs):
+    post = reddit.submission(**kwargs)
+    post.title                  # Fetch now, so that failures are retried
+    return post
+
+def fetch_circle(username):
+    """Fetch a user's circle from embed.json (None if they have none)."""
+    import urllib2
     try:
-        obj = get_circle(username)
+        return call_with_retry('embed', get_circle, username)
     except urllib2.HTTPError as exc:
         if exc.code != 404:
             raise
         logging.warning("Got 404 on circle for %s...", username)
-        if not get_circle(SAFE_CIRCLE):
+        if not call_with_retry('embed', get_circle, SAFE_CIRCLE):
             raise
         logging.warning("...but Circle is still working")
-        obj = None
+        return None
 
+def fetch_things(fullnames):
+    """Fetch submissions and comments by fullname through /api/info, up
+    to REDDIT_PAGE per request. Returns a dictionary of those found."""
+    fullnames = list(fullnames)
+    things = {}
+    for i in range(0, len(fullnames), REDDIT_PAGE):
+        reddit = get_dispatcher().acquire('audit').reddit
+        batch = fullnames[i:i+REDDIT_PAGE]
+        # A new generator for each attempt, since a failed one is partly
+        # consumed
+        for thing in call_with_retry('listings',
+                                     lambda: list(reddit.info(batch))):
+            things[thing.fullname] = thing
+    return things
+
+def refresh_circle(username, dry_run=False, verbose=False, client=None):
+    obj = fetch_circle(username)
     url = 'https://www.reddit.com/comments/%s' % (obj['x_circle_submitted'],) \
           if obj else None
 
@@ -526,15 +1168,25 @@ def refresh_circle(username, dry_run=False, verbose=False):
             print 'No circle for user %s' % (username,)
 
     now = time.time()
-    n = 0
-
-    if not FASTEST_POSSIBLE:
-        time.sleep(REDDIT_GAP)      # Wait after fetching circle
-    reddit = get_reddit()
 
     if url:
-        assert obj
-        post = reddit.submission(url=url)
+        if client is None:
+            client = get_dispatcher().acquire('audit')
+        post = call_with_retry('listings', fetch_submission, client.reddit,
+                               url=url)
+    else:
+        # The user's newest comment (or post) seen, if any
+        fullname = get_last_seen(username)
+        post = fetch_things([fullname]).get(fullname) if fullname else None
+    return observe_audit(username, obj, post, now,
+                         client.reddit if client else None, dry_run, verbose)
+
+def observe_audit(username, obj, post, now, reddit=None, dry_run=False,
+                  verbose=False):
+    """Record an audit, given the user's circle from embed.json (or None)
+    and its submission."""
+    n = 0
+    if obj:
         assert post.id == obj['x_circle_submitted']
         assert post.author.name == obj['x_username']
         assert post.title == obj['x_circle_title'] # FIXME
@@ -546,14 +1198,22 @@ def refresh_circle(username, dry_run=False, verbose=False):
                                 post.title, post.created_utc, betrayed,
                                 audited=now)
     else:
-        assert not obj
         if not dry_run:
             # Just list as audited, don't mark as betrayed
             n += observe_missing_circle(username, None, audited=now)
-        post = find_user_comment(username, reddit=reddit)
+        if post is None or not post.author or \
+           post.author.name.lower() != username.lower():
+            # Not seen recently: search their comment history
+            if reddit is None:
+                # Two pages of comments
+                reddit = get_dispatcher().acquire('audit', cost=2).reddit
+            post = call_with_retry('comments', find_user_comment, username,
+                                   reddit=reddit)
         if not post:
             logging.warning("No circle posts found for user %s", username)
             return 0
+        if not dry_run:
+            observe_seen(post, now)
 
     # Patch stats from view results
     stats = parse_user_flair(post.author_flair_text)
@@ -569,6 +1229,52 @@ def refresh_circle(username, dry_run=False, verbose=False):
     n += observe_user(now, post.author.name, stats)
     return 1 if n > 0 else 0
 
+def refresh_circles(usernames, dry_run=False, pause=None, pause_every=1):
+    """Audit several users, looking up all of their circles' submissions
+    together. Returns the number of updates for each user audited; users
+    whose audits failed are left out. pause, if given, is called after
+    every pause_every users' embed configs are fetched (or after each
+    one, if pause_every is less than one)."""
+    pause_every = max(pause_every, 1)
+    circles = []
+    for i, username in enumerate(usernames):
+        try:
+            circles.append((username, fetch_circle(username), time.time()))
+        except CircuitOpen as e:
+            logging.warning("Stopping audits: %s", e)
+            break
+        except Exception as e:
+            # Carry on with the rest of the batch
+            logging.exception(e)
+        if pause and (i+1) % pause_every == 0:
+            pause()
+
+    # Each circle's submission, or the newest comment seen from users
+    # without one
+    fullnames = dict((username, 't3_' + obj['x_circle_submitted'] if obj
+                      else get_last_seen(username))
+                     for username, obj, now in circles)
+    things = fetch_things(x for x in fullnames.values() if x)
+    results = {}
+    for username, obj, now in circles:
+        try:
+            post = things.get(fullnames[username])
+            if obj:
+                if post is None:
+                    logging.warning("Submission %s not found by /api/info",
+                                    obj['x_circle_submitted'])
+                    reddit = get_dispatcher().acquire('audit').reddit
+                    post = call_with_retry('listings', fetch_submission,
+                                           reddit,
+                                           id=obj['x_circle_submitted'])
+            results[username] = observe_audit(username, obj, post, now,
+                                              dry_run=dry_run)
+        except CircuitOpen as e:
+            logging.warning("Skipping audit of %s: %s", username, e)
+        except Exception as e:
+            logging.exception(e)
+    return results
+
 def run_view(args):
     """Fetch and display information about a given user and their circle."""
 
@@ -577,9 +1283,8 @@ def run_view(args):
         count += refresh_circle(username, dry_run=args.dry_run, verbose=True)
     return save(args, count)
 
-def do_audit(args, query_type, staleness, total=10, sleep=-1):
-    if sleep == -1:
-        sleep = AUDIT_INTERVAL
+def do_audit(args, query_type, staleness, total=10, pause=None,
+             pause_every=1):
     if query_type == -1:
         leaders = get_following_leaders(total, stale_audit=staleness)
     elif query_type in (0, 1, 2):
@@ -589,15 +1294,12 @@ def do_audit(args, query_type, staleness, total=10, sleep=-1):
     else:
         raise ValueError
 
-    count = 0
-    for row in leaders:
-        author = row[0]
-        logging.info("Auditing %s (query type %d)", author, query_type)
-        n = refresh_circle(author, dry_run=False, verbose=False)
-        count += n
-        save(args, n)
-        if sleep:
-            time.sleep(sleep)
+    authors = [row[0] for row in leaders]
+    logging.info("Auditing %s (query type %d)", ', '.join(authors),
+                 query_type)
+    count = sum(refresh_circles(authors, dry_run=False, pause=pause,
+                                pause_every=pause_every).values())
+    save(args, count)
     if total > 1:
         logging.info("Total updates found: %d", count)
     return count, len(leaders)
@@ -605,7 +1307,375 @@ def do_audit(args, query_type, staleness, total=10, sleep=-1):
 def run_audit(args):
     """Audit the next batch of users from the given leaderboard."""
 
-    return do_audit(args, args.query_type, args.staleness, total=args.count)
+    result = do_audit(args, args.query_type, args.staleness, total=args.count)
+    get_dispatcher().log_stats()
+    log_breakers()
+    return result
+
+######################################################################
+# DISTRIBUTED WORK QUEUE
+######################################################################
+
+WORK_LEASE = 5*60               # Seconds before a claimed job expires
+WORK_RETRY = 60                 # Seconds before a failed job is retried
+WORK_AUDITS = 4                 # Audits claimed per iteration
+WORK_CANDIDATES = 10            # Stale users queued from each leaderboard
+WORK_COMMENTS_TIME = 20         # Seconds spent on comments per iteration
+WORK_LEADERBOARD_INTERVAL = 100 # Seconds between leaderboard updates
+
+# Listings observed by the daemons, and seconds between observations
+# (matching the single-daemon cycle of about 100-second iterations)
+WORK_LISTINGS = (
+    ('/hot', 500), ('/top', 500), ('/top/day', 500),
+    ('NOT flair:betrayed', 500), ('flair:betrayed', 1000),
+    ('/rising', 1000),
+)
+
+class WorkQueue(object):
+    """Jobs shared by several daemons through the work table. A daemon
+    claims a job by taking a lease on it; if the daemon does not finish
+    the job before the lease expires, another daemon can claim it."""
+
+    def __init__(self, dbfile, owner=None, lease=WORK_LEASE):
+        import socket
+        self.owner = owner or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.lease = lease
+        # Separate connection, so that claims commit independently
+        self.db = sqlite3.connect(dbfile, timeout=60, isolation_level=None)
+        self.stats = Counter()
+
+    def add(self, kind, arg, priority=0, available=0):
+        """Queue a job, unless the same job is already queued."""
+        self.db.execute('INSERT OR IGNORE INTO work(job, kind, arg, ' +
+                        'priority, available) VALUES(?, ?, ?, ?, ?)',
+                        ('%s:%s' % (kind, arg.lower()), kind, arg,
+                         priority, available))
+
+    def claim(self, kind, count=1):
+        """Lease up to count available jobs of the given kind, returning
+        a list of (job, arg) pairs."""
+        now = time.time()
+        cur = self.db.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            cur.execute('SELECT job, arg FROM work WHERE kind=? AND ' +
+                        'available <= ? AND (expires IS NULL OR expires < ?) ' +
+                        'ORDER BY priority ASC, available ASC LIMIT ?',
+                        (kind, now, now, count))
+            jobs = cur.fetchall()
+            cur.executemany('UPDATE work SET owner=?, expires=? WHERE job=?',
+                            [(self.owner, now+self.lease, job)
+                             for job, arg in jobs])
+            cur.execute('COMMIT')
+        except:
+            cur.execute('ROLLBACK')
+            raise
+        self.stats[kind] += len(jobs)
+        return jobs
+
+    def hold(self, kind, arg=''):
+        """Take or renew the lease on a job that only one daemon should
+        run at a time. Returns True if this daemon holds the lease."""
+        now = time.time()
+        self.add(kind, arg)
+        cur = self.db.execute('UPDATE work SET owner=?, expires=? ' +
+                              'WHERE job=? AND (owner=? OR expires IS NULL ' +
+                              'OR expires < ?)',
+                              (self.owner, now+self.lease,
+                               '%s:%s' % (kind, arg.lower()), self.owner, now))
+        return cur.rowcount == 1
+
+    def finish(self, job, again=None):
+        """Complete a claimed job. Recurring jobs become available again
+        after the given number of seconds."""
+        if again is None:
+            self.db.execute('DELETE FROM work WHERE job=? AND owner=?',
+                            (job, self.owner))
+        else:
+            self.release(job, again)
+
+    def release(self, job, delay=WORK_RETRY):
+        """Give up a claimed job, making it available after a delay."""
+        self.db.execute('UPDATE work SET owner=NULL, expires=NULL, ' +
+                        'available=? WHERE job=? AND owner=?',
+                        (time.time()+delay, job, self.owner))
+
+    def log_stats(self):
+        logging.info("Worker %s claimed: %s", self.owner, ', '.join(
+            '%s %d' % x for x in sorted(self.stats.items())))
+
+def queue_audits(queue):
+    """Queue the users that need auditing from the top of each
+    leaderboard."""
+    for query_type in (0, -1):
+        if query_type == -1:
+            leaders = get_following_leaders(WORK_CANDIDATES,
+                                            stale_audit=DEFAULT_STALENESS)
+        else:
+            leaders = get_leaders(WORK_CANDIDATES,
+                                  stale_audit=DEFAULT_STALENESS)
+        for rank, row in enumerate(leaders):
+            queue.add('audit', row[0], priority=rank)
+
+def run_queue_daemon(args):
+    """Daemon mode sharing its work with other daemons through the work
+    queue."""
+
+    if args.dry_run:
+        # Claims would wait forever on the uncommitted observations
+        logging.error("The work queue cannot be used with --dry-run")
+        return
+    queue = WorkQueue(get_config()["dbfile"])
+    intervals = dict(WORK_LISTINGS)
+    for query, interval in WORK_LISTINGS:
+        queue.add('observe', query)
+    if args.update:
+        queue.add('leaderboard', args.update)
+    comment_stream = None
+    logging.info("Starting queue worker %s", queue.owner)
+
+    while True:
+        iteration_start = time.time()
+        busy = False
+
+        # Observe listings that are due
+        if not args.no_observe:
+            for job, query in queue.claim('observe'):
+                busy = True
+                try:
+                    do_observe(args, query)
+                    queue.finish(job, again=intervals.get(query, 500))
+                except Exception as e:
+                    logging.exception(e)
+                    queue.release(job)
+
+        # Audit users; a failed audit is retried by whoever claims it next
+        try:
+            queue_audits(queue)
+        except Exception as e:
+            logging.exception(e)
+        jobs = dict((author, job) for job, author
+                    in queue.claim('audit', WORK_AUDITS))
+        if jobs:
+            busy = True
+            logging.info("Auditing %s (queued)", ', '.join(jobs))
+            try:
+                results = refresh_circles(jobs.keys())
+            except Exception as e:
+                logging.exception(e)
+                results = {}
+            save(args, sum(results.values()))
+            for author, job in jobs.items():
+                if author in results:
+                    queue.finish(job)
+                else:
+                    queue.release(job)
+
+        # Only one daemon follows the comment stream
+        if queue.hold('comments'):
+            busy = True
+            try:
+                if comment_stream is None:
+                    comment_stream = do_observe_comments(args, pause_after=0)
+                    comment_stream.next()
+                comment_stream.send(time.time() + WORK_COMMENTS_TIME)
+            except Exception as e:
+                logging.exception(e)
+                comment_stream = None
+
+        # Update leaderboard
+        for job, postid in queue.claim('leaderboard'):
+            busy = True
+            try:
+                do_leaderboard(postid)
+                queue.finish(job, again=WORK_LEADERBOARD_INTERVAL)
+            except Exception as e:
+                logging.exception(e)
+                queue.release(job)
+
+        logging.info('---- Iteration took %d seconds ----',
+                     time.time() - iteration_start)
+        queue.log_stats()
+        get_dispatcher().log_stats()
+        log_breakers()
+        if not busy:
+            time.sleep(REDDIT_GAP*5)
+
+######################################################################
+# WEBSOCKET SUBSCRIPTIONS
+######################################################################
+
+# The embed config of each circle gives a websocket URL on which changes
+# to the circle are pushed, as JSON messages with the changed embed
+# config values in their payload:
+#   {"type": "circle_update", "payload": {"circle_num_inside": 12,
+#    "circle_num_outside": 3, "circle_is_betrayed": false}}
+SUBSCRIBE_COUNT = 25            # Top active circles to subscribe to
+SUBSCRIBE_REFRESH = 5*60        # Seconds between choosing circles
+SUBSCRIBE_STATS = 60            # Seconds between logging stats
+SUBSCRIBE_RETRY = 60            # Seconds between reconnection attempts
+SUBSCRIBE_TIMEOUT = 10          # Socket timeout in seconds
+
+def _buffered(ws):
+    """Whether a websocket's SSL connection holds data that has already
+    been read and decrypted, which select() doesn't see."""
+    pending = getattr(ws.sock, 'pending', None)
+    return bool(pending and pending())
+
+class CircleSubscriber(object):
+    """Hold websocket connections for the top circles, turning pushed
+    changes into observations. A circle whose socket drops is polled
+    through embed.json instead, until it can be reconnected. Subscribed
+    circles are not marked as audited, since the pushes don't include
+    the owner's flair, so audits still refresh it."""
+
+    def __init__(self, count, commit):
+        self.count = count
+        # Called with the number of entries updated after each poll or
+        # batch of messages, so that the write lock is held briefly
+        self.commit = commit
+        self.sockets = {}       # Author -> websocket
+        self.retry = {}         # Author -> next reconnection attempt
+        self.circles = {}       # Author -> (postid, title, created)
+        self.stats = Counter()
+
+    def choose(self):
+        """Subscribe to the current top circles, and drop the others."""
+        leaders = get_leaders(self.count, False, existing_only=True)
+        self.circles = dict((row[0], (row[4], row[5], row[7]))
+                            for row in leaders)
+        for author in self.sockets.keys():
+            if author not in self.circles:
+                logging.info("Unsubscribing from %s", author)
+                self.sockets.pop(author).close()
+        for author in self.retry.keys():
+            if author not in self.circles:
+                del self.retry[author]
+        return sum(self.connect(author) for author in self.circles
+                   if author not in self.sockets and author not in self.retry)
+
+    def reconnect(self):
+        """Poll and reconnect circles whose sockets dropped."""
+        now = time.time()
+        return sum(self.connect(author) for author, when
+                   in self.retry.items() if when <= now)
+
+    def connect(self, author):
+        import websocket
+        # The embed config is a fresh observation, and has the socket URL
+        try:
+            obj = call_with_retry('embed', get_circle, author)
+        except Exception as exc:
+            logging.warning("Could not poll circle of %s: %s", author, exc)
+            self.retry[author] = time.time() + SUBSCRIBE_RETRY
+            return 0
+        self.stats['polls'] += 1
+        n = self.update(author, obj)
+        self.commit(n)
+        try:
+            self.sockets[author] = websocket.create_connection(
+                obj['circle_websocket_url'], timeout=SUBSCRIBE_TIMEOUT)
+        except Exception as exc:
+            logging.warning("Could not subscribe to %s: %s", author, exc)
+            self.retry[author] = time.time() + SUBSCRIBE_RETRY
+            return n
+        logging.info("Subscribed to %s", author)
+        self.stats['connects'] += 1
+        self.retry.pop(author, None)
+        return n
+
+    def drop(self, author, reason):
+        logging.warning("Lost subscription to %s (%s), polling instead",
+                        author, reason)
+        self.stats['drops'] += 1
+        try:
+            self.sockets.pop(author).close()
+        except Exception:
+            pass
+        # Catch up on anything missed right away
+        self.retry[author] = 0
+
+    def update(self, author, config, now=None):
+        """Observe the given embed config values for a circle."""
+        if now is None:
+            now = time.time()
+        postid, title, created = self.circles[author]
+        n = 0
+        if 'circle_is_betrayed' in config:
+            betrayed = now if config['circle_is_betrayed'] else None
+            n += observe_circle(postid, author, title, created, betrayed)
+        if 'circle_num_inside' in config:
+            # Only the size is pushed; keep the rest from the flair
+            c.execute('SELECT following, betrayer FROM user ' +
+                      'WHERE authorid=? ORDER BY time DESC LIMIT 1',
+                      (author_id(author),))
+            following, betrayer = c.fetchone() or (None, None)
+            n += observe_user(now, author, UserStats(
+                config['circle_num_inside'], following, betrayer))
+        return 1 if n > 0 else 0
+
+    def receive(self, timeout):
+        """Wait for pushed messages, and observe them."""
+        import select
+        import socket
+        import websocket
+        authors = dict((ws, author) for author, ws in self.sockets.items())
+        if not authors:
+            time.sleep(timeout)
+            return 0
+        buffered = [ws for ws in authors if _buffered(ws)]
+        readable = select.select(authors.keys(), [], [],
+                                 0 if buffered else timeout)[0]
+        readable = set(readable).union(buffered)
+        n = 0
+        for ws in readable:
+            author = authors[ws]
+            # Read every frame, including those already buffered
+            while True:
+                try:
+                    message = ws.recv()
+                except (websocket.WebSocketException, socket.error) as exc:
+                    self.drop(author, exc)
+                    break
+                if not message:
+                    self.drop(author, 'closed')
+                    break
+                self.stats['messages'] += 1
+                try:
+                    payload = json.loads(message)['payload']
+                except (ValueError, KeyError, TypeError):
+                    logging.warning("Unknown message for %s: %r", author,
+                                    message)
+                else:
+                    n += self.update(author, payload)
+                if not _buffered(ws):
+                    break
+        if readable:
+            self.commit(n)
+        return n
+
+    def log_stats(self):
+        logging.info("Subscribed to %d circles (%d polled): %s",
+                     len(self.sockets), len(self.retry), ', '.join(
+                         '%s %d' % x for x in sorted(self.stats.items())))
+
+def run_subscribe(args):
+    """Follow the top circles through their websockets, polling any
+    whose socket drops."""
+
+    subscriber = CircleSubscriber(args.count, lambda n: save(args, n))
+    next_choose = next_stats = 0
+    while True:
+        now = time.time()
+        if now >= next_choose:
+            subscriber.choose()
+            next_choose = now + SUBSCRIBE_REFRESH
+        subscriber.reconnect()
+        subscriber.receive(REDDIT_GAP)
+        if time.time() >= next_stats:
+            subscriber.log_stats()
+            log_breakers()
+            next_stats = time.time() + SUBSCRIBE_STATS
 
 ######################################################################
 # LEADERBOARD GENERATION
@@ -631,9 +1701,18 @@ def _urlencode(query):
     _quote = lambda s: urllib.quote_plus(s, ',:*[]')
     return '&'.join(_quote(k) + '=' + _quote(v) for k, v in query.items())
 
-def make_plot(points, title, created=None, betrayed=None, audited=None,
-              with_timestamp=True, title_prefix=None, force_snap=False,
-              betrayer=None, now=None, verbose=False):
+# Chart of a resampled series, independent of the rendering backend.
+# values holds PLOT_NPOINTS samples (None for gaps), xrange the ends of
+# the time axis in xunits, dates the (day, label) clock axis ticks
+# within date_range, and betraypoint the position of the betrayal mark
+# as a fraction of the time axis.
+Chart = namedtuple('Chart', ('title', 'red', 'values', 'yrange', 'xrange',
+                             'xunit', 'dates', 'date_range', 'betraypoint',
+                             'width', 'height'))
+
+def make_chart(points, title, created=None, betrayed=None, audited=None,
+               with_timestamp=True, title_prefix=None, force_snap=False,
+               betrayer=None, now=None):
     if DISABLE_PLOTS:
         return None
     if now is None:
@@ -656,7 +1735,7 @@ def make_plot(points, title, created=None, betrayed=None, audited=None,
     dx = (end-start)/(npoints-1)
 
     p = 0
-    chd = 's:'
+    values = []
     dchar = yrange/(len(CHART_CODING)-1)
     for i in range(npoints):
         x = int(start + i*dx)
@@ -669,22 +1748,23 @@ def make_plot(points, title, created=None, betrayed=None, audited=None,
             # Even though we have no further datapoints, we know it
             # can't have changed prior to our most recent audit
             # (because if it had, there would be another data point).
-            assert len(chd) > 2
-            chd += chd[-1]
+            assert values
+            values.append(values[-1])
         elif p >= len(points):
-            chd += '_'
+            values.append(None)
         elif points[p][1] is None:
-            chd += '_'
+            values.append(None)
         elif (p == 0 or (p > 0 and
                          points[p][0]-points[p-1][0] > 2*ONE_HOUR and
-                         abs(points[p][1]-points[p-1][1]) > 3*dchar)) and \
+                         (points[p-1][1] is None or
+                          abs(points[p][1]-points[p-1][1]) > 3*dchar))) and \
              points[p][0]-x > dx:
             # For the initial gap and any gap longer than two hours,
             # show a break in the line. But don't show a break for a
             # long gap if there was only a small change. (Assume inactivity)
-            chd += '_'
+            values.append(None)
         else:
-            chd += _chart_encode(points[p][1], yrange)
+            values.append(points[p][1])
 
     # Determine dates. NOT GOOD PRACTICE, but I don't expect issues
     # with time zones or daylight savings or leap seconds while Circle
@@ -719,44 +1799,272 @@ def make_plot(points, title, created=None, betrayed=None, audited=None,
     else:
         xfactor, xunit = 60, 'm' # Minutes
 
-    chart = {
+    # Mark betrayer
+    betraypoint = None
+    if betrayer:
+        logging.debug("Betrayer mark at %s (%s after creation, %s into " +
+                      "the chart of %s)", betrayer, betrayer-created,
+                      betrayer-created-start, end-start)
+        betrayer -= created
+        betraypoint = (betrayer-start)*1./(end-start)
+
+    return Chart(
+        title=title_prefix + ('%s [%s]' % (title, format_lifetime(end))
+                              if with_timestamp else title),
+        # Title is red if betrayed (size) or a betrayer (circles)
+        red=bool(betrayed or betrayer),
+        values=values, yrange=yrange,
+        xrange=(start/xfactor, end/xfactor), xunit=xunit,
+        dates=dates, date_range=(start_date, end_date),
+        betraypoint=betraypoint, width=width, height=height)
+
+def chart_url(chart, verbose=False):
+    """Render a chart as a Google Image Charts URL."""
+    if not chart:
+        return None
+    chd = 's:' + ''.join('_' if val is None else
+                         _chart_encode(val, chart.yrange)
+                         for val in chart.values)
+    dates = chart.dates
+    url_chart = {
         'cht': 'lc',                      # Chart type: line chart
-        'chs': '%dx%d' % (width, height), # Chart size
+        'chs': '%dx%d' % (chart.width, chart.height), # Chart size
         'chd': chd,             # Chart data, encoded as above
         # Chart title
-        'chtt': title_prefix + ('%s [%s]' % (title, format_lifetime(end))
-                                if with_timestamp else title),
-        # Title is red if betrayed (size) or a betrayer (circles)
-        'chts': 'ff0000' if (betrayed or betrayer) else '000000',
+        'chtt': chart.title,
+        'chts': 'ff0000' if chart.red else '000000',
         # Chart axes: x-axis (time), y-axis, x-axis (wall clock)
         'chxt': 'x,y,x',
         # Axis styles
-        'chxs': ('0N*f*' + xunit + ',000000,12,0,lt|' + # X-axis format
+        'chxs': ('0N*f*' + chart.xunit + ',000000,12,0,lt|' + # X-axis format
                  '1,000000,12,1,lt|' + # Y-axis format
                  '2,333333,10,0,t'), # Clock-axis format
         # Axis ranges
         'chxr': '0,%f,%f|1,0,%f|2,%.3f,%.3f' % (
-            start/xfactor, end/xfactor, yrange, start_date, end_date),
+            chart.xrange + (chart.yrange,) + chart.date_range),
         # Axis labels (clock axis)
-        'chxtc': '2,-%d' % (height,),
+        'chxtc': '2,-%d' % (chart.height,),
         'chxp': '2,' + ','.join(str(x[0]) for x in dates),
         'chxl': '2:|' + '|'.join(x[1] for x in dates),
     }
 
     # Mark betrayer
-    if betrayer:
-        print betrayer, betrayer-created, betrayer-created-start, end-start
-        betrayer -= created
-        betraypoint = (betrayer-start)*1./(end-start)
-        chart['chm'] = 'R,dd0000,0,%.3f,%.3f' % (betraypoint,
-                                                 betraypoint+0.004)
+    if chart.betraypoint is not None:
+        url_chart['chm'] = 'R,dd0000,0,%.3f,%.3f' % (chart.betraypoint,
+                                                     chart.betraypoint+0.004)
 
     if verbose:
-        print '\n'.join('='.join(x) for x in chart.items())
+        print '\n'.join('='.join(x) for x in url_chart.items())
+
+    return CHART_BASEURL + _urlencode(url_chart)
 
-    return CHART_BASEURL + _urlencode(chart)
+def make_plot(points, title, created=None, betrayed=None, audited=None,
+              with_timestamp=True, title_prefix=None, force_snap=False,
+              betrayer=None, now=None, verbose=False):
+    return chart_url(make_chart(points, title, created, betrayed, audited,
+                                with_timestamp, title_prefix, force_snap,
+                                betrayer, now), verbose=verbose)
+
+# Local rendering backend (SVG files)
+SVG_MARGINS = (40, 10, 22, 34)  # Left, right, top, bottom
+
+def _nice_step(span, maxticks):
+    step = 1
+    while span/step > maxticks:
+        for factor in (2, 2.5, 2):
+            step *= factor
+            if span/step <= maxticks:
+                break
+    return step
+
+def _svg_escape(data):
+    return data.replace('&', '&amp;').replace('<', '&lt;') \
+               .replace('>', '&gt;').replace('"', '&quot;')
+
+def chart_svg(chart):
+    """Render a chart as an SVG document (UTF-8 encoded)."""
+    left, right, top, bottom = SVG_MARGINS
+    width, height = chart.width, chart.height
+    plot_width = width - left - right
+    plot_height = height - top - bottom
+    xstart, xend = chart.xrange
+    date_start, date_end = chart.date_range
+
+    def _x(frac):
+        return left + frac*plot_width
+
+    def _y(val):
+        return top + plot_height - val*plot_height/chart.yrange
+
+    svg = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" '
+           'font-family="sans-serif">' % (width, height),
+           '<rect width="100%" height="100%" fill="#ffffff"/>',
+           '<text x="%d" y="15" font-size="13" text-anchor="middle" '
+           'fill="#%s">%s</text>' % (width/2, 'ff0000' if chart.red
+                                     else '000000',
+                                     _svg_escape(chart.title))]
+
+    # Clock axis, with gridlines
+    for d, label in chart.dates:
+        x = _x((d-date_start)/(date_end-date_start)
+               if date_end > date_start else 0)
+        svg.append('<line x1="%.1f" y1="%d" x2="%.1f" y2="%d" '
+                   'stroke="#cccccc"/>' % (x, top, x, top+plot_height))
+        svg.append('<text x="%.1f" y="%d" font-size="10" fill="#333333">'
+                   '%s</text>' % (x, height-3, _svg_escape(label.strip())))
+
+    # Elapsed-time axis
+    step = _nice_step(xend-xstart, 8)
+    tick = (int(xstart/step)+1)*step if xstart % step else xstart
+    while tick <= xend:
+        x = _x((tick-xstart)/(xend-xstart) if xend > xstart else 0)
+        svg.append('<text x="%.1f" y="%d" font-size="12" '
+                   'text-anchor="middle">%g%s</text>' %
+                   (x, top+plot_height+14, tick, chart.xunit))
+        tick += step
+
+    # Value axis
+    step = _nice_step(chart.yrange, 5)
+    tick = 0
+    while tick <= chart.yrange:
+        svg.append('<text x="%d" y="%.1f" font-size="12" text-anchor="end">'
+                   '%g</text>' % (left-4, _y(tick)+4, tick))
+        tick += step
+    svg.append('<path d="M%d %d V%d H%d" fill="none" stroke="#000000"/>' %
+               (left, top, top+plot_height, left+plot_width))
+
+    # Betrayal mark
+    if chart.betraypoint is not None:
+        svg.append('<rect x="%.1f" y="%d" width="%.1f" height="%d" '
+                   'fill="#dd0000"/>' % (_x(chart.betraypoint), top,
+                                         max(0.004*plot_width, 1),
+                                         plot_height))
+
+    # Data, with a break in the line at each gap
+    npoints = len(chart.values)
+    path, pen = [], 'M'
+    for i, val in enumerate(chart.values):
+        if val is None:
+            pen = 'M'
+            continue
+        path.append('%s%.1f %.1f' % (pen, _x(i*1./(npoints-1)), _y(val)))
+        pen = 'L'
+    if path:
+        svg.append('<path d="%s" fill="none" stroke="#4d89f9" '
+                   'stroke-width="2"/>' % (' '.join(path),))
+    svg.append('</svg>')
+    return '\n'.join(svg).encode('utf-8')
+
+def render_svg_charts(charts, outdir, workers=None):
+    """Render a dictionary of charts to outdir/NAME.svg on a pool of
+    worker processes, skipping charts that have not changed since they
+    were last rendered."""
+    import hashlib
+    import multiprocessing
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    manifest_file = os.path.join(outdir, 'charts.json')
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    pending = []
+    for name, chart in sorted(charts.items()):
+        digest = hashlib.sha1(repr(chart)).hexdigest()
+        path = os.path.join(outdir, name + '.svg')
+        if manifest.get(name) != digest or not os.path.exists(path):
+            pending.append((name, chart, digest))
+
+    if workers != 1 and len(pending) > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            svgs = pool.map(chart_svg, [x[1] for x in pending])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        svgs = [chart_svg(x[1]) for x in pending]
+
+    for (name, chart, digest), svg in zip(pending, svgs):
+        path = os.path.join(outdir, name + '.svg')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(svg)
+        os.rename(path + '.tmp', path)
+        manifest[name] = digest
+    if pending:
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump(manifest, f, sort_keys=True)
+        os.rename(manifest_file + '.tmp', manifest_file)
+    logging.info("Rendered %d of %d charts (%d unchanged)", len(pending),
+                 len(charts), len(charts)-len(pending))
+    return len(pending)
+
+# Chart relay: charts are uploaded under a hash of their content, so
+# the post can link to short relay URLs (chart_relay_base + ID)
+RELAY_ID_LENGTH = 12            # Hex digits of SHA-1 in relay chart IDs
+RELAY_BATCH_SIZE = 100          # Charts per upload request
+RELAY_RETRIES = 3               # Retries for each failed upload
+
+def relay_chart_id(title, url):
+    import hashlib
+    digest = hashlib.sha1((u'%s\n%s' % (title, url)).encode('utf-8'))
+    return digest.hexdigest()[:RELAY_ID_LENGTH]
+
+def upload_charts(upload_url, charts, dry_run=False):
+    """Upload charts (a dictionary of relay chart IDs to titles and URLs)
+    that have not already been uploaded to the relay. With dry_run, the
+    uploads are recorded without committing."""
+    import gzip
+    import urllib2
+    from StringIO import StringIO
+
+    chartids = sorted(charts.keys())
+    uploaded = set()
+    for i in range(0, len(chartids), 500):
+        chunk = chartids[i:i+500]
+        c.execute('SELECT id FROM relay WHERE id IN (%s)' %
+                  (','.join('?' for x in chunk),), chunk)
+        uploaded.update(row[0] for row in c.fetchall())
+    pending = [x for x in chartids if x not in uploaded]
+
+    for i in range(0, len(pending), RELAY_BATCH_SIZE):
+        batch = pending[i:i+RELAY_BATCH_SIZE]
+        body = StringIO()
+        with gzip.GzipFile(fileobj=body, mode='wb') as f:
+            json.dump({'charts': dict((x, charts[x]) for x in batch)}, f,
+                      separators=(',', ':'))
+        req = urllib2.Request(upload_url, body.getvalue(), {
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip',
+            'User-Agent': get_config()["user_agent"],
+        })
+        for attempt in range(RELAY_RETRIES+1):
+            try:
+                urllib2.urlopen(req, timeout=30).read()
+                break
+            except urllib2.HTTPError as exc:
+                if exc.code < 500 or attempt == RELAY_RETRIES:
+                    raise
+                logging.warning("Chart upload failed (HTTP %d), retrying",
+                                exc.code)
+            except urllib2.URLError as exc:
+                if attempt == RELAY_RETRIES:
+                    raise
+                logging.warning("Chart upload failed (%s), retrying",
+                                exc.reason)
+            time.sleep(2**attempt)
+        now = time.time()
+        c.executemany('INSERT OR IGNORE INTO relay(id, uploaded) ' +
+                      'VALUES(?, ?)', [(x, now) for x in batch])
+        if not dry_run:
+            db.commit()
+    logging.info("Uploaded %d of %d charts to relay (%d unchanged)",
+                 len(pending), len(charts), len(uploaded))
+    return len(pending)
 
-def do_plot(author, min_points=None, verbose=False, end=None):
+def do_plot(author, min_points=None, end=None, until=None):
     query = 'SELECT title, created, betrayed, audited FROM circle ' + \
             'WHERE author=?'
     c.execute(query, (author,))
@@ -764,40 +2072,54 @@ def do_plot(author, min_points=None, verbose=False, end=None):
     if not result:
         return None
     title, created, betrayed, audited = result
-    query = 'SELECT time, followers FROM user WHERE author=? ' + \
+    query = 'SELECT time, followers FROM user WHERE authorid=? ' + \
             'ORDER BY time ASC'
-    c.execute(query, (author,))
+    c.execute(query, (author_id(author, create=False),))
     points = c.fetchall()
+    if until is not None:
+        # Only what was known at the given time
+        points = [x for x in points if x[0] <= until]
+        betrayed = betrayed if betrayed <= until else None
+        audited = audited if audited <= until else None
     if min_points and len(points) < min_points:
         return None
-    return make_plot(points, author, created, betrayed, audited,
-                     title_prefix='Circle: ', now=end, verbose=verbose)
+    return make_chart(points, author, created, betrayed, audited,
+                      title_prefix='Circle: ', now=end)
 
-def do_plot_following(author, min_points=None, verbose=False, end=None):
-    query = 'SELECT time, following, betrayer FROM user WHERE author=? ' + \
-            'ORDER BY time ASC'
-    c.execute(query, (author,))
+def first_betrayal(points):
+    """Estimate when a user first betrayed a circle, given a list of
+    (time, following, betrayer) observations."""
+    if not points or not points[-1][2]:
+        return None
+    for i, r in enumerate(points):
+        if r[2]:
+            return r[0] if i == 0 else (points[i-1][0]+points[i][0])/2
+    return None
+
+def do_plot_following(author, min_points=None, end=None, until=None):
+    query = 'SELECT time, following, betrayer FROM user ' + \
+            'WHERE authorid=? ORDER BY time ASC'
+    c.execute(query, (author_id(author, create=False),))
     points = c.fetchall()
+    if until is not None:
+        points = [x for x in points if x[0] <= until]
     if min_points and len(points) < min_points:
         return None
-    betrayer = None
-    if points[-1][2]:
-        for i, r in enumerate(points):
-            if r[2]:
-                betrayer = r[0] if i == 0 else (points[i-1][0]+points[i][0])/2
-                break
-    return make_plot(points, author, created=CIRCLE_RESET_TIME,
-                     #force_snap=True,
-                     title_prefix='Joined: ', with_timestamp=False,
-                     betrayer=betrayer, now=end, verbose=verbose)
+    betrayer = first_betrayal(points)
+    return make_chart(points, author, created=CIRCLE_RESET_TIME,
+                      #force_snap=True,
+                      title_prefix='Joined: ', with_timestamp=False,
+                      betrayer=betrayer, now=end)
 
 def run_plot(args):
     """Produce plots for a given user."""
 
     end_time = CIRCLE_ENDED if CIRCLE_ENDED else None
-    print "=> Followers:", do_plot(args.username, verbose=True, end=end_time)
-    print "=> Following:", do_plot_following(args.username, verbose=True,
-                                             end=end_time)
+    print "=> Followers:", chart_url(do_plot(args.username, end=end_time),
+                                     verbose=True)
+    print "=> Following:", chart_url(do_plot_following(args.username,
+                                                       end=end_time),
+                                     verbose=True)
 
 # From snudown, &()- removed; only escape . after a digit.
 MARKDOWN_SPECIAL_RE = re.compile(r'[\\`*_{}\[\]#+!:|<>/^~]|(?<=\d)\.',
@@ -815,10 +2137,338 @@ def allow_linebreak(data):
         return match.group(0) + '&#8203;' # zero-width space
     return LONG_WORD_RE.sub(_replacement, data)
 
+class RankingIndex(object):
+    """The leaderboards kept sorted in memory, in the orders used by
+    get_leaders and get_following_leaders, and updated by each
+    observation. Observations made by other processes (noticed through
+    PRAGMA data_version) are then read by rowid, and the circle table is
+    re-read."""
+
+    BOARDS = ('active', 'betrayed', 'users')
+
+    def __init__(self):
+        self.load()
+
+    def load(self):
+        self.users = {}         # Lowercased author -> newest observation
+        self.circles = {}       # Lowercased author -> circle row
+        self.keys = {}          # (Board, lowercased author) -> sort key
+        self.boards = dict((board, []) for board in self.BOARDS)
+        c.execute('PRAGMA data_version')
+        self.data_version = c.fetchone()[0]
+        c.execute('SELECT author, following FROM peak')
+        self.peaks = dict((row[0].lower(), row[1]) for row in c)
+        c.execute('SELECT author, id, title, created, betrayed FROM circle')
+        for row in c.fetchall():
+            self.circles[row[0].lower()] = row[1:]
+        # Sorting the whole table is faster than walking by_time (+time)
+        c.execute('SELECT user.rowid, time, name, followers, following, ' +
+                  'betrayer ' +
+                  'FROM user INNER JOIN author ON author.id == authorid ' +
+                  'ORDER BY +time ASC, user.rowid ASC')
+        self.last_rowid = 0
+        for row in c:
+            self.users[row[2].lower()] = row[1:]
+            self.last_rowid = max(self.last_rowid, row[0])
+        for key in self.users:
+            self._place(key, sort=False)
+        for board in self.boards.values():
+            board.sort()
+        logging.info("Loaded rankings for %d users", len(self.users))
+
+    def _place(self, key, sort=True):
+        """Move an author to their current place on each board."""
+        for board in self.BOARDS:
+            sortkey = self.keys.pop((board, key), None)
+            if sortkey is not None:
+                ranking = self.boards[board]
+                del ranking[bisect.bisect_left(ranking, sortkey)]
+        user = self.users.get(key)
+        circle = self.circles.get(key)
+        if not user or not circle:
+            return
+        obstime, author, followers, following, betrayer = user
+        postid, title, created, betrayed = circle
+        # SQLite sorts NULL below any number
+        places = [('users', (following is None, -(following or 0),
+                             followers is None, -(followers or 0), key))]
+        if postid is not None:
+            places.append(('betrayed' if betrayed else 'active',
+                           (followers is None, -(followers or 0),
+                            created is not None, created, key)))
+        for board, sortkey in places:
+            self.keys[(board, key)] = sortkey
+            if sort:
+                bisect.insort(self.boards[board], sortkey)
+            else:
+                self.boards[board].append(sortkey)
+
+    def observe_user(self, now, author, stats):
+        key = author.lower()
+        user = self.users.get(key)
+        if user is None or now >= user[0]:
+            self.users[key] = (now, author) + tuple(stats)
+            self._place(key)
+
+    def observe_peak(self, author, following):
+        key = author.lower()
+        if following > self.peaks.get(key):
+            self.peaks[key] = following
+
+    def reload_circle(self, postid, author):
+        if postid:
+            c.execute('SELECT author, id, title, created, betrayed ' +
+                      'FROM circle WHERE id=?', (postid,))
+        else:
+            c.execute('SELECT author, id, title, created, betrayed ' +
+                      'FROM circle WHERE author=?', (author,))
+        row = c.fetchone()
+        if row:
+            self.circles[row[0].lower()] = row[1:]
+            self._place(row[0].lower())
+
+    def refresh(self):
+        """Apply the observations and circle changes made by other
+        processes since the last refresh."""
+        c.execute('PRAGMA data_version')
+        data_version = c.fetchone()[0]
+        if data_version == self.data_version:
+            return
+        c.execute('SELECT user.rowid, time, name, followers, following, ' +
+                  'betrayer FROM user ' +
+                  'INNER JOIN author ON author.id == authorid ' +
+                  'WHERE user.rowid > ? ORDER BY user.rowid ASC',
+                  (self.last_rowid,))
+        for row in c.fetchall():
+            stats = UserStats(*row[3:])
+            self.observe_user(row[1], row[2], stats)
+            # The peak table is kept from the same observations
+            if stats.following is not None:
+                self.observe_peak(row[2], stats.following)
+            self.last_rowid = row[0]
+        c.execute('SELECT author, id, title, created, betrayed FROM circle')
+        circles = dict((row[0].lower(), row[1:]) for row in c)
+        changed = [key for key, circle in circles.iteritems()
+                   if self.circles.get(key) != circle]
+        changed.extend(self.circles.viewkeys() - circles.viewkeys())
+        self.circles = circles
+        for key in changed:
+            self._place(key)
+        self.data_version = data_version
+
+    def top(self, board, count):
+        """Return the top of a board, in the row format of get_leaders
+        (or get_following_leaders, for the users board)."""
+        self.refresh()
+        rows = []
+        for sortkey in self.boards[board][:count]:
+            key = sortkey[-1]
+            obstime, author, followers, following, betrayer = self.users[key]
+            if board == 'users':
+                rows.append((author, followers, following, betrayer,
+                             self.peaks.get(key)))
+            else:
+                postid, title, created, betrayed = self.circles[key]
+                rows.append((author, followers, following, betrayer, postid,
+                             title, betrayed, created))
+        return rows
+
+# Rankings index, used by get_leaders and get_following_leaders once
+# enabled by long-running processes (see enable_rankings)
+_rankings = None
+
+def enable_rankings():
+    global _rankings
+    if _rankings is None:
+        _rankings = RankingIndex()
+    return _rankings
+
+def check_rankings(count=100):
+    """Compare the rankings index with the SQL leaderboards, reloading it
+    if they differ. Returns the number of differences."""
+    global _rankings
+    rankings, _rankings = _rankings, None
+    try:
+        expected = {
+            'active': get_leaders(count, False, existing_only=True),
+            'betrayed': get_leaders(count, True, existing_only=True),
+            'users': get_following_leaders(count),
+        }
+    finally:
+        _rankings = rankings
+    differences = 0
+    for board, rows in expected.items():
+        actual = rankings.top(board, count)
+        # Ties may be in any order, so compare sort values, then rows
+        values = (lambda x: x[1:3]) if board == 'users' else \
+                 (lambda x: (x[1], x[7]))
+        byauthor = dict((row[0], row) for row in actual)
+        mismatched = sum(1 for x, y in zip(rows, actual)
+                         if values(x) != values(y)) + \
+                     abs(len(rows) - len(actual)) + \
+                     sum(1 for row in rows if row[0] in byauthor and
+                         tuple(byauthor[row[0]]) != tuple(row))
+        if mismatched:
+            logging.warning("Rankings index differs from SQL for %s board " +
+                            "in %d rows", board, mismatched)
+        differences += mismatched
+    if differences:
+        rankings.load()
+    else:
+        logging.info("Rankings index matches SQL (top %d)", count)
+    return differences
+
+def _delta(old, new):
+    return None if old is None or new is None else new - old
+
+class VelocityTracker(object):
+    """Recent growth of each user, from the newest observation in each
+    of the last VELOCITY_BUCKETS periods of VELOCITY_WINDOW, so memory
+    stays constant per user. It is seeded from the observations within
+    the window only, and observations made by other processes (noticed
+    through PRAGMA data_version) are then read by rowid."""
+
+    def __init__(self):
+        self.period = float(VELOCITY_WINDOW) / VELOCITY_BUCKETS
+        self.samples = {}       # Lowercased author -> deque of samples
+        self.last_time = None   # Time of the newest observation
+        self.last_rowid = 0
+        self.data_version = None
+
+    def observe(self, now, author, stats):
+        key = author.lower()
+        bucket = int(now // self.period)
+        samples = self.samples.get(key)
+        if samples is None:
+            # One more than the window, to keep a sample from before it
+            samples = self.samples[key] = deque(maxlen=VELOCITY_BUCKETS+1)
+        elif now < samples[-1][1]:
+            return              # Older than the newest sample
+        elif samples[-1][0] == bucket:
+            samples.pop()       # Keep only the newest in each period
+        samples.append((bucket, now, author, stats))
+        if now > self.last_time:
+            self.last_time = now
+
+    def load(self):
+        """Read the observations in the window ending at the newest one
+        (through the by_time index), and the newest observation before
+        it of each user observed within it."""
+        c.execute('PRAGMA data_version')
+        self.data_version = c.fetchone()[0]
+        # Separately, so that each is a single index lookup
+        c.execute('SELECT max(rowid) FROM user')
+        self.last_rowid = c.fetchone()[0] or 0
+        c.execute('SELECT max(time) FROM user')
+        latest = c.fetchone()[0]
+        if latest is None:
+            return
+        # One period more, since the window starts partway through one
+        start = latest - VELOCITY_WINDOW - self.period
+        c.execute('SELECT name, max(time), followers, following, betrayer ' +
+                  'FROM user INNER JOIN author ON author.id == authorid ' +
+                  'WHERE authorid IN (SELECT authorid FROM user ' +
+                  '    WHERE time > ?) AND time <= ? GROUP BY authorid',
+                  (start, start))
+        for row in c.fetchall():
+            self.observe(row[1], row[0], UserStats(*row[2:]))
+        c.execute('SELECT time, name, followers, following, betrayer ' +
+                  'FROM user INNER JOIN author ON author.id == authorid ' +
+                  'WHERE time > ? ORDER BY time ASC, user.rowid ASC',
+                  (start,))
+        for row in c:
+            self.observe(row[0], row[1], UserStats(*row[2:]))
+        logging.info("Loaded velocity for %d users", len(self.samples))
+
+    def refresh(self):
+        """Read the observations added by other processes since the last
+        refresh."""
+        if self.data_version is None:
+            return self.load()
+        c.execute('PRAGMA data_version')
+        data_version = c.fetchone()[0]
+        if data_version == self.data_version:
+            return
+        c.execute('SELECT user.rowid, time, name, followers, following, ' +
+                  'betrayer FROM user ' +
+                  'INNER JOIN author ON author.id == authorid ' +
+                  'WHERE user.rowid > ? ORDER BY user.rowid ASC',
+                  (self.last_rowid,))
+        for row in c:
+            self.observe(row[1], row[2], UserStats(*row[3:]))
+            self.last_rowid = row[0]
+        self.data_version = data_version
+
+    def growth(self, now=None):
+        """Yield the newest observation of each user observed within the
+        window ending at now (by default, the newest observation), and the
+        changes in followers and following since the start of the window
+        (None where either count is unknown)."""
+        if now is None:
+            now = self.last_time
+        if now is None:
+            return
+        start = int((now - VELOCITY_WINDOW) // self.period)
+        for samples in self.samples.itervalues():
+            if samples[-1][0] <= start:
+                continue
+            # Compare with the newest sample from before the window, or
+            # else the oldest within it
+            base = samples[0]
+            for sample in samples:
+                if sample[0] > start:
+                    break
+                base = sample
+            bucket, obstime, author, stats = samples[-1]
+            yield obstime, author, stats, \
+                _delta(base[3].followers, stats.followers), \
+                _delta(base[3].following, stats.following)
+
+    def leaders(self, count, circles, now=None):
+        """The circles that gained the most members, in the row format of
+        get_leaders with the changes in followers and following appended.
+        circles maps each lowercased author of an active circle to its
+        id, title, betrayal time and creation time."""
+        def _rows():
+            for obstime, author, stats, gained, joined in self.growth(now):
+                circle = circles.get(author.lower())
+                if gained > 0 and circle:
+                    postid, title, betrayed, created = circle
+                    yield (author, stats.followers, stats.following,
+                           stats.betrayer, postid, title, betrayed, created,
+                           gained, joined)
+        return heapq.nsmallest(count, _rows(), key=lambda x: (
+            -x[8], -x[1], x[7] is not None, x[7], x[0].lower()))
+
+# Growth of each user, kept by long-running processes for the fastest
+# growing board (see enable_velocity)
+_velocity = None
+
+def enable_velocity():
+    global _velocity
+    if _velocity is None:
+        _velocity = VelocityTracker()
+        _velocity.load()
+    return _velocity
+
+def get_growing_leaders(count):
+    """The active circles that gained the most members over the last
+    VELOCITY_WINDOW, in the row format of get_leaders with the changes
+    in followers and following appended."""
+    velocity = enable_velocity()
+    velocity.refresh()
+    c.execute('SELECT author, id, title, betrayed, created FROM circle ' +
+              'WHERE id NOT NULL AND (betrayed == 0 OR betrayed IS NULL)')
+    return velocity.leaders(count, dict((row[0].lower(), row[1:])
+                                        for row in c))
+
 def get_leaders(count, betrayed=None, stale_audit=0, existing_only=False):
+    if _rankings and betrayed is not None and existing_only and \
+       not stale_audit:
+        return _rankings.top('betrayed' if betrayed else 'active', count)
     whereclause = []
     if existing_only:
-        whereclause.append('id NOT NULL')
+        whereclause.append('circle.id NOT NULL')
     if betrayed is not None:
         betrayclause = 'betrayed'
         if betrayed is True:
@@ -842,14 +2492,18 @@ def get_leaders(count, betrayed=None, stale_audit=0, existing_only=False):
 
     whereclause = ('WHERE (' + ') AND ('.join(whereclause) + ') ') \
                   if whereclause else ''
-    query = 'SELECT user.author, followers, following, betrayer, id, ' + \
+    # +user.time keeps SQLite finding each newest row through by_author
+    # (a few rows per user) rather than by_time
+    query = 'SELECT name, followers, following, betrayer, circle.id, ' + \
             '    title, betrayed, created FROM ' + \
-            '(SELECT author, max(time) as maxtime FROM user ' + \
-            '    GROUP BY author) AS newest ' + \
-            'INNER JOIN user ON user.author == newest.author AND ' + \
-            '    user.time == newest.maxtime ' + \
-            'INNER JOIN circle ON circle.author == user.author ' + \
-            whereclause + 'ORDER BY followers DESC, created ASC LIMIT ?;'
+            '(SELECT authorid, max(time) as maxtime FROM user ' + \
+            '    GROUP BY authorid) AS newest ' + \
+            'INNER JOIN user ON user.authorid == newest.authorid AND ' + \
+            '    +user.time == newest.maxtime ' + \
+            'INNER JOIN author ON author.id == user.authorid ' + \
+            'INNER JOIN circle ON circle.author == name ' + \
+            whereclause + \
+            'ORDER BY followers DESC, created ASC, name ASC LIMIT ?;'
 
     # In case of a tie, older circles retain higher position, even
     # though one could consider faster growth to be a greater achievement
@@ -857,53 +2511,263 @@ def get_leaders(count, betrayed=None, stale_audit=0, existing_only=False):
     return c.fetchall()
 
 def get_following_leaders(count, stale_audit=0):
+    if _rankings and not stale_audit:
+        return _rankings.top('users', count)
     whereclause = []
     if stale_audit:
         assert stale_audit >= 1
         #  OR time-audited > %d [[[with stale_audit]] doesn't work for
         #  circles with no changes
         whereclause.append('audited IS NULL OR ' +
-                           ('max(time, audited) < %d ' %
+                           ('max(user.time, audited) < %d ' %
                             ((circle_now()-stale_audit),)))
 
     whereclause = ('WHERE (' + ') AND ('.join(whereclause) + ') ') \
                   if whereclause else ''
-    query = 'SELECT user.author, followers, following, betrayer FROM ' + \
-            '(SELECT author, max(time) as maxtime FROM user ' + \
-            '    GROUP BY author) AS newest ' + \
-            'INNER JOIN user ON user.author == newest.author AND ' + \
-            '    user.time == newest.maxtime ' + \
-            'INNER JOIN circle ON circle.author == user.author ' + \
-            whereclause + 'ORDER BY following DESC, followers DESC LIMIT ?;'
+    # +user.time: see get_leaders
+    query = 'SELECT name, followers, user.following, betrayer, ' + \
+            '    peak.following FROM ' + \
+            '(SELECT authorid, max(time) as maxtime FROM user ' + \
+            '    GROUP BY authorid) AS newest ' + \
+            'INNER JOIN user ON user.authorid == newest.authorid AND ' + \
+            '    +user.time == newest.maxtime ' + \
+            'INNER JOIN author ON author.id == user.authorid ' + \
+            'INNER JOIN circle ON circle.author == name ' + \
+            'LEFT JOIN peak ON peak.author == name ' + \
+            whereclause + \
+            'ORDER BY user.following DESC, followers DESC, name ASC ' + \
+            'LIMIT ?;'
     c.execute(query, (count,))
     return c.fetchall()
 
-def get_max_following(author):
-    query = 'SELECT max(following) FROM user WHERE author=?;'
-    c.execute(query, (author,))
-    row = c.fetchone()
-    return row[0] if row else None
+def parse_time(text):
+    """Parse a Unix timestamp or a 'YYYY-MM-DD HH:MM' time in PDT."""
+    try:
+        return float(text)
+    except ValueError:
+        import calendar
+        dt = datetime.datetime.strptime(text, '%Y-%m-%d %H:%M')
+        # Circle ran entirely within PDT (UTC-7)
+        return calendar.timegm(dt.timetuple()) + 7*ONE_HOUR
+
+class LeaderboardHistory(object):
+    """Rank the leaderboards as they stood at past times, by sweeping
+    forwards through the observations in time order and keeping the
+    newest observation of each user."""
+
+    def __init__(self):
+        c.execute('SELECT author, id, title, betrayed, created FROM circle')
+        self.circles = dict((row[0].lower(), row[1:]) for row in c)
+        self.latest = {}        # Newest observation of each circle owner
+        self.peaks = {}
+        self.velocity = VelocityTracker()
+        self.now = None
+        self.last_time = None   # Time of the newest observation so far
+        # A separate cursor, since charts are queried during the sweep
+        # (and +time, as in RankingIndex.load)
+        self.rows = db.cursor()
+        self.rows.execute('SELECT time, name, followers, following, ' +
+                          'betrayer FROM user ' +
+                          'INNER JOIN author ON author.id == authorid ' +
+                          'ORDER BY +time ASC, user.rowid ASC')
+        self.pending = self.rows.fetchone()
+
+    def advance(self, when):
+        """Apply all observations up to the given time."""
+        assert self.now is None or when >= self.now
+        row = self.pending
+        while row and row[0] <= when:
+            key = row[1].lower()
+            if key in self.circles:
+                self.latest[key] = row
+                if row[3] is not None and row[3] > self.peaks.get(key, -1):
+                    self.peaks[key] = row[3]
+                self.velocity.observe(row[0], row[1], UserStats(*row[2:]))
+            self.last_time = row[0]
+            row = self.rows.fetchone()
+        self.pending = row
+        self.now = when
+
+    def leaders(self, count, betrayed):
+        """Like get_leaders(count, betrayed, existing_only=True)."""
+        def _rows():
+            for key, (obstime, author, followers, following,
+                      betrayer) in self.latest.iteritems():
+                postid, title, betraytime, created = self.circles[key]
+                if postid is None or created > self.now:
+                    continue
+                if not betraytime or betraytime > self.now:
+                    betraytime = None
+                if bool(betraytime) == betrayed:
+                    yield (author, followers, following, betrayer, postid,
+                           title, betraytime, created)
+        # Same order as SQL, where NULL is less than any number
+        return heapq.nsmallest(count, _rows(), key=lambda x: (
+            x[1] is None, -(x[1] or 0), x[7] is not None, x[7]))
+
+    def growing_leaders(self, count):
+        """Like get_growing_leaders(count)."""
+        circles = {}
+        for key, (postid, title, betrayed, created) in \
+                self.circles.iteritems():
+            if postid is not None and created <= self.now and \
+               (not betrayed or betrayed > self.now):
+                circles[key] = (postid, title, None, created)
+        return self.velocity.leaders(count, circles, self.now)
+
+    def following_leaders(self, count):
+        """Like get_following_leaders(count)."""
+        rows = ((author, followers, following, betrayer, self.peaks.get(key))
+                for key, (obstime, author, followers, following, betrayer)
+                in self.latest.iteritems())
+        return heapq.nsmallest(count, rows, key=lambda x: (
+            x[2] is None, -(x[2] or 0), x[1] is None, -(x[1] or 0)))
+
+# Leaderboard sections: board, file name with --output-dir, symbol and
+# title
+LEADERBOARD_SECTIONS = (
+    ('active', 'active', JOIN_SYMBOL, 'Active circles'),
+    ('growing', 'fastest-growing', GROWING_SYMBOL, 'Fastest growing circles'),
+    ('betrayed', 'betrayed', BETRAY_SYMBOL, 'Betrayed circles'),
+    ('users', 'most-circles', USERS_SYMBOL, 'Users in the most circles'),
+)
+
+# CSV columns of each board (see _leader_json)
+SECTION_CSV_FIELDS = {
+    'active': ('rank', 'author', 'id', 'title', 'followers', 'following',
+               'betrayer', 'created', 'betrayed', 'chart'),
+    'users': ('rank', 'author', 'following', 'peak', 'followers',
+              'betrayer', 'chart'),
+}
+SECTION_CSV_FIELDS['betrayed'] = SECTION_CSV_FIELDS['active']
+SECTION_CSV_FIELDS['growing'] = SECTION_CSV_FIELDS['active'][:5] + \
+    ('gained',) + SECTION_CSV_FIELDS['active'][5:6] + \
+    ('following_gained',) + SECTION_CSV_FIELDS['active'][6:]
+
+class SectionWriter(object):
+    """Writes one leaderboard section to a file, a row at a time, through
+    write(rank, row, chart), which each subclass defines. The file is
+    replaced when the writer is closed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.out = open(path + '.tmp', 'wb')
+
+    def close(self):
+        self.out.close()
+        os.rename(self.path + '.tmp', self.path)
+
+class MarkdownSectionWriter(SectionWriter):
+    def __init__(self, path, heading, legend, format_row):
+        super(MarkdownSectionWriter, self).__init__(path)
+        self.format_row = format_row
+        self.out.write('# %s\n\n' % (heading,))
+        self.out.write('|'.join(legend) + '\n')
+        self.out.write('|'.join('-' for l in legend) + '\n')
+
+    def write(self, rank, row, chart):
+        self.out.write(self.format_row(rank, row, chart) + '\n')
+
+class HTMLSectionWriter(SectionWriter):
+    def __init__(self, path, title, heading, legend, format_cells):
+        super(HTMLSectionWriter, self).__init__(path)
+        self.format_cells = format_cells
+        self.out.write('<!DOCTYPE html>\n<html>\n<head>\n' +
+                       '<meta charset="utf-8">\n' +
+                       '<title>%s</title>\n</head>\n<body>\n' % (title,) +
+                       '<h1>%s</h1>\n<table>\n<thead>\n<tr>' % (heading,) +
+                       ''.join('<th>%s</th>' % (x,) for x in legend) +
+                       '</tr>\n</thead>\n<tbody>\n')
+
+    def write(self, rank, row, chart):
+        self.out.write(('<tr>' + ''.join(
+            '<td>%s</td>' % (x,) for x in self.format_cells(rank, row, chart)
+        ) + '</tr>\n').encode('utf-8'))
+
+    def close(self):
+        self.out.write('</tbody>\n</table>\n</body>\n</html>\n')
+        super(HTMLSectionWriter, self).close()
+
+class JSONSectionWriter(SectionWriter):
+    def __init__(self, path, board):
+        super(JSONSectionWriter, self).__init__(path)
+        self.board = board
+        self.rows = 0
+
+    def write(self, rank, row, chart):
+        entry = _leader_json(self.board, rank, row)
+        entry['chart'] = chart
+        self.out.write(',\n' if self.rows else '[\n')
+        json.dump(entry, self.out, separators=(',', ':'), sort_keys=True)
+        self.rows += 1
+
+    def close(self):
+        self.out.write('\n]\n' if self.rows else '[]\n')
+        super(JSONSectionWriter, self).close()
+
+class CSVSectionWriter(SectionWriter):
+    def __init__(self, path, board):
+        import csv
+        super(CSVSectionWriter, self).__init__(path)
+        self.board = board
+        self.fields = SECTION_CSV_FIELDS[board]
+        self.writer = csv.writer(self.out)
+        self.writer.writerow(self.fields)
+
+    def write(self, rank, row, chart):
+        entry = _leader_json(self.board, rank, row)
+        entry['chart'] = chart
+        self.writer.writerow([
+            '' if entry[x] is None else
+            entry[x].encode('utf-8') if isinstance(entry[x], unicode) else
+            entry[x] for x in self.fields])
+
+# Optional formats with --output-dir (Markdown and HTML are always written)
+SECTION_WRITERS = {
+    'json': JSONSectionWriter,
+    'csv': CSVSectionWriter,
+}
 
 def post_permalink(postid):
     return 'https://redd.it/' + postid
     #return '//redd.it/' + postid
 
-def do_leaderboard(update=None, length=None, full_urls=False):
+def do_leaderboard(update=None, length=None, full_urls=False, svg_dir=None,
+                   history=None, out=None, output_dir=None, formats=(),
+                   dry_run=False):
     if length is None:
         length = 25
 
     now = time.time()
-    chart_upload = CONFIG["chart_relay_upload"]
-    chart_base = CONFIG["chart_relay_base"]
+    ended = CIRCLE_ENDED
+    if history:
+        # A past leaderboard, as ranked by history.advance()
+        now = ended = until = history.now
+        if CIRCLE_ENDED:
+            ended = min(ended, CIRCLE_ENDED)
+    else:
+        until = None
+    config = get_config()
+    chart_upload = config["chart_relay_upload"]
+    chart_base = config["chart_relay_base"]
     charturls = {} if (chart_base and update) else None
     charttitleprefix = {'c': 'Circle: ', 'u': 'Joined: '}
-
-    def _wrap_plot(url, prefix, username):
+    if svg_dir is None:
+        svg_dir = config.get("chart_svg_dir")
+    svg_base = config.get("chart_svg_base", '')
+    svgcharts = {} if svg_dir else None
+
+    def _wrap_plot(chart, prefix, username):
+        if svgcharts is not None and chart:
+            name = '%s-%s' % (prefix, username)
+            svgcharts[name] = chart
+            return svg_base + name + '.svg'
+        url = chart_url(chart)
         if charturls is None or not url:
             return url
-        chartid = '%s:%s' % (prefix, username)
-        charturls[chartid] = {'title': charttitleprefix[prefix] + username,
-                              'url': url}
+        title = charttitleprefix[prefix] + username
+        chartid = relay_chart_id(title, url)
+        charturls[chartid] = {'title': title, 'url': url}
         return chart_base + chartid
 
     def _link_user(author, label=None, suffix=None):
@@ -917,82 +2781,167 @@ def do_leaderboard(update=None, length=None, full_urls=False):
         else:
             return url
 
+    def _end_time(betrayed=None):
+        if betrayed:
+            return betrayed
+        elif ended:
+            return ended
+        return now
+
+    def _anonymous(row):
+        return row[0].lower() in config['anonymize']
+
+    def _plot_circle(row):
+        author, betrayed = row[0], row[6]
+        return _wrap_plot(do_plot(author, min_points=10,
+                                  end=_end_time(betrayed), until=until),
+                          'c', author)
+
+    def _plot_user(row):
+        author = row[0]
+        return _wrap_plot(do_plot_following(author, min_points=10,
+                                            end=_end_time(), until=until),
+                          'u', author)
+
+    def _rows(board):
+        """Yield the rank, row and chart URL of each leader, drawing
+        each chart once for all output formats."""
+        plot = _plot_user if board == 'users' else _plot_circle
+        for i, row in enumerate(boards[board]):
+            yield i+1, row, None if _anonymous(row) else plot(row)
+
     circle_legend = ("\\#", "Circle", "Size", "Age", "Owner")
-    def _render_circles(leaders):
-        yield '|'.join(circle_legend)
-        yield '|'.join('-' for l in circle_legend)
-        for i, row in enumerate(leaders):
-            author, followers, following, betrayer, postid, title, \
-                betrayed, created = row
-            if author.lower() in CONFIG['anonymize']:
-                yield '|'.join(
-                    (str(i+1), '*Anonymous circle*', str(followers),
-                     '&mdash;', '&mdash;')).encode('utf-8')
-                continue
-            #if not postid:
-            #    link = '[*Collecting data...*](/u/%s/circle/)' % (author,)
-            #    age = '&mdash;'
-            #else:
-            link = '[%s](%s)' % \
-                   (allow_linebreak(escape_markdown(title)),
-                    post_permalink(postid))
-            if betrayed:
-                end_time = betrayed
-            elif CIRCLE_ENDED:
-                end_time = CIRCLE_ENDED
-            else:
-                end_time = now
-            age = format_lifetime(end_time-created)
-            authorinfo = '&mdash;' if following is None else '%d' % (following,)
-            if betrayer:
-                authorinfo += ' ' + BETRAY_SYMBOL
-            followers = str(followers)
-            plot = _wrap_plot(do_plot(author, min_points=10, end=end_time),
-                              'c', author)
-            if plot:
-                followers = '[%s](%s)' % (followers, plot)
-            author = '%s (%s)' % (_link_user(author), authorinfo)
-            yield '|'.join(
-                (str(i+1), link, str(followers), age, author)
-            ).encode('utf-8')
+    growing_legend = circle_legend[:3] + \
+        ("Gain (%dh)" % (VELOCITY_WINDOW/ONE_HOUR),) + circle_legend[3:]
+    def _markdown_circle(rank, row, plot):
+        author, followers, following, betrayer, postid, title, \
+            betrayed, created = row[:8]
+        # Members gained, on the fastest growing board
+        gained = ('+%d' % (row[8],),) if len(row) > 8 else ()
+        if _anonymous(row):
+            return '|'.join(
+                (str(rank), '*Anonymous circle*', str(followers)) + gained +
+                ('&mdash;', '&mdash;')).encode('utf-8')
+        #if not postid:
+        #    link = '[*Collecting data...*](/u/%s/circle/)' % (author,)
+        #    age = '&mdash;'
+        #else:
+        link = '[%s](%s)' % \
+               (allow_linebreak(escape_markdown(title)),
+                post_permalink(postid))
+        age = format_lifetime(_end_time(betrayed)-created)
+        authorinfo = '&mdash;' if following is None else '%d' % (following,)
+        if betrayer:
+            authorinfo += ' ' + BETRAY_SYMBOL
+        followers = str(followers)
+        if plot:
+            followers = '[%s](%s)' % (followers, plot)
+        author = '%s (%s)' % (_link_user(author), authorinfo)
+        return '|'.join(
+            (str(rank), link, str(followers)) + gained + (age, author)
+        ).encode('utf-8')
 
     user_legend = ("\\#", "User", BETRAY_SYMBOL, "Joined", "Peak", "Own Circle")
-    def _render_users(leaders):
-        yield '|'.join(user_legend)
-        yield '|'.join('-' for l in user_legend)
-        for i, row in enumerate(leaders):
-            author, followers, following, betrayer = row
-            if author.lower() in CONFIG['anonymize']:
-                yield '|'.join((str(i+1), '*Anonymous user*', betrayer,
-                                str(following), '&mdash;')).encode('utf-8')
-                continue
-            if full_urls:
-                followers = _link_user(author, followers, '/circle/') \
-                            if followers else '&mdash;'
-                # '[%s](/u/%s/circle/)' % (followers, author)
-            else:
-                followers = str(followers) if followers else '&mdash;'
-            betrayer = BETRAY_SYMBOL if betrayer else ''
-            following = str(following)
-            if CIRCLE_ENDED:
-                end_time = CIRCLE_ENDED
-            else:
-                end_time = now
-            plot = _wrap_plot(do_plot_following(author, min_points=10,
-                                                end=end_time), 'u', author)
-            if plot:
-                following = '[%s](%s)' % (following, plot)
-            peak = get_max_following(author)
-            peak = str(peak) if peak is not None else ''
-            author = _link_user(author)
-            yield '|'.join(
-                (str(i+1), author, betrayer, following, peak, followers)
-            ).encode('utf-8')
+    def _markdown_user(rank, row, plot):
+        author, followers, following, betrayer, peak = row
+        betrayer = BETRAY_SYMBOL if betrayer else ''
+        if _anonymous(row):
+            return '|'.join((str(rank), '*Anonymous user*', betrayer,
+                             str(following), '&mdash;')).encode('utf-8')
+        if full_urls:
+            followers = _link_user(author, followers, '/circle/') \
+                        if followers else '&mdash;'
+            # '[%s](/u/%s/circle/)' % (followers, author)
+        else:
+            followers = str(followers) if followers else '&mdash;'
+        following = str(following)
+        if plot:
+            following = '[%s](%s)' % (following, plot)
+        peak = str(peak) if peak is not None else ''
+        author = _link_user(author)
+        return '|'.join(
+            (str(rank), author, betrayer, following, peak, followers)
+        ).encode('utf-8')
+
+    def _html_link(label, url):
+        return '<a href="%s">%s</a>' % (_svg_escape(url), label)
+
+    def _html_circle(rank, row, plot):
+        author, followers, following, betrayer, postid, title, \
+            betrayed, created = row[:8]
+        gained = ['+%d' % (row[8],)] if len(row) > 8 else []
+        if _anonymous(row):
+            return [str(rank), '<em>Anonymous circle</em>', str(followers)] + \
+                gained + ['&mdash;', '&mdash;']
+        authorinfo = '&mdash;' if following is None else '%d' % (following,)
+        if betrayer:
+            authorinfo += ' ' + BETRAY_SYMBOL
+        followers = str(followers)
+        return [
+            str(rank),
+            _html_link(_svg_escape(title), post_permalink(postid)),
+            _html_link(followers, plot) if plot else followers,
+        ] + gained + [
+            format_lifetime(_end_time(betrayed)-created),
+            '%s (%s)' % (_html_link('u/' + author,
+                                    'https://www.reddit.com/u/' + author),
+                         authorinfo),
+        ]
+
+    def _html_user(rank, row, plot):
+        author, followers, following, betrayer, peak = row
+        betrayer = BETRAY_SYMBOL if betrayer else ''
+        if _anonymous(row):
+            return [str(rank), '<em>Anonymous user</em>', betrayer,
+                    str(following), '&mdash;']
+        url = 'https://www.reddit.com/u/' + author
+        following = str(following)
+        return [
+            str(rank),
+            _html_link('u/' + author, url),
+            betrayer,
+            _html_link(following, plot) if plot else following,
+            str(peak) if peak is not None else '',
+            _html_link(str(followers), url + '/circle/') if followers \
+            else '&mdash;',
+        ]
+
+    # Legend and Markdown and HTML row formatters of each board
+    renderers = {
+        'active': (circle_legend, _markdown_circle, _html_circle),
+        'growing': (growing_legend, _markdown_circle, _html_circle),
+        'betrayed': (circle_legend, _markdown_circle, _html_circle),
+        'users': (user_legend, _markdown_user, _html_user),
+    }
 
-    def _leaderboard_stamp():
+    def _markdown(board):
+        legend, row, html = renderers[board]
+        return [
+            '|'.join(legend),
+            '|'.join('-' for l in legend),
+        ] + [row(*x) for x in _rows(board)]
+
+    if history:
+        stamp_time = history.last_time or history.now
+        boards = {
+            'active': history.leaders(length, False),
+            'growing': history.growing_leaders(min(length, GROWING_LENGTH)),
+            'betrayed': history.leaders(length, True),
+            'users': history.following_leaders(length),
+        }
+    else:
         c.execute('SELECT time FROM user ORDER BY time DESC LIMIT 1')
-        row = c.fetchone()
-        dt = datetime.datetime.fromtimestamp(row[0], pytz.utc)
+        stamp_time = c.fetchone()[0]
+        boards = {
+            'active': get_leaders(length, False, existing_only=True),
+            'growing': get_growing_leaders(min(length, GROWING_LENGTH)),
+            'betrayed': get_leaders(length, True, existing_only=True),
+            'users': get_following_leaders(length),
+        }
+
+    def _leaderboard_stamp():
+        import pytz
+        dt = datetime.datetime.fromtimestamp(stamp_time, pytz.utc)
         dttz = dt.astimezone(pytz.timezone('America/Los_Angeles'))
         dtstr = dttz.strftime('%d %b, %I:%M %p PDT (UTC-7)').lstrip('0')
         if False:
@@ -1001,83 +2950,237 @@ def do_leaderboard(update=None, length=None, full_urls=False):
                      (dtstr, dttz.strftime('%Y%m%dT%H%M'))
         return dtstr
 
-    def _active_circles():
-        return list(_render_circles(get_leaders(length, False,
-                                                existing_only=True)))
-
-    def _betrayed_circles():
-        return list(_render_circles(get_leaders(length, True,
-                                                existing_only=True)))
-
-    def _following_users():
-        return list(_render_users(get_following_leaders(length)))
+    if output_dir:
+        # Each section is written in every format in one pass over its
+        # rows
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        for board, filename, symbol, title in LEADERBOARD_SECTIONS:
+            heading = '%s &nbsp; %s' % (symbol, title)
+            legend, markdown, html = renderers[board]
+            path = os.path.join(output_dir, filename)
+            writers = [
+                MarkdownSectionWriter(path + '.md', heading, legend,
+                                      markdown),
+                HTMLSectionWriter(path + '.html', title, heading,
+                                  ('#',) + legend[1:], html),
+            ]
+            for fmt in formats:
+                writers.append(SECTION_WRITERS[fmt](path + '.' + fmt, board))
+            for rank, row, plot in _rows(board):
+                for writer in writers:
+                    writer.write(rank, row, plot)
+            for writer in writers:
+                writer.close()
+            logging.info("Wrote %s (%d rows)", ', '.join(
+                os.path.basename(x.path) for x in writers), len(boards[board]))
+        if svgcharts:
+            render_svg_charts(svgcharts, svg_dir)
+        return
 
     leaderboard = [
         x.rstrip('\r\n') for x in open('postheader.txt').readlines()
     ] + [
         'Last update: %s' % (_leaderboard_stamp(),),
-        '',
-        '# %s &nbsp; Active circles' % (JOIN_SYMBOL,),
-        '',
-    ] + _active_circles() + [
-        '',
-        '# %s &nbsp; Betrayed circles' % (BETRAY_SYMBOL,),
-        '',
-    ] + _betrayed_circles() + [
-        '',
-        '# %s &nbsp; Users in the most circles' % (USERS_SYMBOL,),
-        '',
-    ] + _following_users()
+    ]
+    for board, filename, symbol, title in LEADERBOARD_SECTIONS:
+        leaderboard += ['', '# %s &nbsp; %s' % (symbol, title), '']
+        leaderboard += _markdown(board)
 
     leaderboard = '\n'.join(leaderboard)
+    if svgcharts:
+        render_svg_charts(svgcharts, svg_dir)
     if update:
-        if charturls is not None and not DISABLE_PLOTS:
-            assert False
-            urllib2.urlopen(chart_upload, data=urllib.urlencode({
-                'data': json.dumps(charturls)
-            })).read()
-        reddit = get_reddit()
+        import praw
+        if charturls:
+            upload_charts(chart_upload, charturls, dry_run)
+        # Edits are made by the account that owns the post
+        dispatcher = get_dispatcher()
+        reddit = dispatcher.acquire('edit', client=dispatcher.clients[0]).reddit
         post = reddit.submission(id=update)
         try:
-            post.edit(leaderboard)
+            call_with_retry('edit', post.edit, leaderboard)
         except praw.exceptions.APIException as exc:
             if exc.error_type != 'TOO_LONG':
                 raise
             logging.error("Leaderboard update failed: length is %d > 40000",
                           len(leaderboard))
+        else:
+            archive_leaderboard(update, now, stamp_time, boards, dry_run)
     else:
-        print leaderboard
+        print >>(out or sys.stdout), leaderboard
 
 def run_leaderboard(args):
     """Generate the leaderboards."""
 
-    return do_leaderboard(args.update, args.length, args.full_urls)
+    formats = [x for x in ('json', 'csv') if getattr(args, x)]
+    if args.archived is not None:
+        try:
+            board = load_archived(args.archived)
+        except KeyError as exc:
+            logging.error("%s", exc.args[0])
+            return
+        return do_leaderboard(None, args.length, args.full_urls, args.svg_dir,
+                              history=board, output_dir=args.output_dir,
+                              formats=formats)
+    if args.output_dir and args.update:
+        logging.error("Leaderboard files cannot be written with --update")
+        return
+    if args.as_of is None:
+        return do_leaderboard(args.update, args.length, args.full_urls,
+                              args.svg_dir, output_dir=args.output_dir,
+                              formats=formats, dry_run=args.dry_run)
+    if args.update:
+        logging.error("Past leaderboards cannot be posted")
+        return
+    history = LeaderboardHistory()
+    if args.until is None:
+        history.advance(args.as_of)
+        return do_leaderboard(None, args.length, args.full_urls, args.svg_dir,
+                              history=history, output_dir=args.output_dir,
+                              formats=formats)
+
+    # Range mode: one file per snapshot, from a single sweep
+    if args.output_dir:
+        logging.error("Use --snapshot-dir with --until, not --output-dir")
+        return
+    if args.every <= 0:
+        logging.error("--every must be a positive number of seconds")
+        return
+    when = args.as_of
+    while when <= args.until:
+        history.advance(when)
+        filename = os.path.join(args.snapshot_dir,
+                                'leaderboard-%d.md' % (when,))
+        with open(filename, 'w') as f:
+            do_leaderboard(None, args.length, args.full_urls, args.svg_dir,
+                           history=history, out=f)
+        logging.info("Wrote %s", filename)
+        when += args.every
+
+# Archive of published leaderboards. Each board (active, betrayed,
+# users) is stored as its changes from the previously published one: the
+# new order, as previous ranks or names of new entries, new rows, and
+# the changed fields of other rows. Every ARCHIVE_KEYFRAME-th board is
+# stored in full (as changes from an empty board), so that
+# reconstructing any board reads at most that many rows.
+ARCHIVE_KEYFRAME = 50
+
+def _archive_delta(old, new):
+    oldrank = dict((row[0], i) for i, row in enumerate(old))
+    order, rows = [], {}
+    for row in new:
+        i = oldrank.get(row[0])
+        if i is None:
+            rows[row[0]] = row
+        elif tuple(old[i]) != tuple(row):
+            rows[row[0]] = dict((str(j), y) for j, (x, y)
+                                in enumerate(zip(old[i], row)) if x != y)
+        order.append(row[0] if i is None else i)
+    return {'order': order, 'rows': rows}
+
+def _archive_apply(old, delta):
+    rows = delta['rows']
+    new = []
+    for x in delta['order']:
+        if isinstance(x, basestring):
+            new.append(tuple(rows[x]))
+            continue
+        row = old[x]
+        if row[0] in rows:
+            row = list(row)
+            for j, y in rows[row[0]].items():
+                row[int(j)] = y
+            row = tuple(row)
+        new.append(row)
+    return new
+
+class ArchivedBoard(object):
+    """A published leaderboard, reconstructed from the archive, with the
+    interface of LeaderboardHistory."""
+
+    def __init__(self, seq, now, postid, stamp, boards):
+        self.seq = seq
+        self.now = now
+        self.postid = postid
+        self.last_time = stamp
+        self.boards = boards
+
+    def leaders(self, count, betrayed):
+        return self.boards['betrayed' if betrayed else 'active'][:count]
+
+    def following_leaders(self, count):
+        return self.boards['users'][:count]
+
+    def growing_leaders(self, count):
+        # Not recorded by older archives
+        return self.boards.get('growing', [])[:count]
+
+def load_archived(seq):
+    import zlib
+    c.execute('SELECT max(seq) FROM archive WHERE keyframe AND seq <= ?',
+              (seq,))
+    keyframe = c.fetchone()[0]
+    if keyframe is None:
+        raise KeyError("No archived leaderboard %d" % (seq,))
+    c.execute('SELECT seq, time, postid, data FROM archive ' +
+              'WHERE seq >= ? AND seq <= ? ORDER BY seq ASC',
+              (keyframe, seq))
+    boards = {}
+    for rowseq, now, postid, data in c.fetchall():
+        record = json.loads(zlib.decompress(data))
+        boards = dict((name, _archive_apply(boards.get(name, []), delta))
+                      for name, delta in record['boards'].items())
+    if rowseq != seq:
+        raise KeyError("No archived leaderboard %d" % (seq,))
+    return ArchivedBoard(seq, now, postid, record['stamp'], boards)
+
+def archive_leaderboard(postid, now, stamp, boards, dry_run=False):
+    """Record a published leaderboard in the archive (without committing,
+    with dry_run)."""
+    import zlib
+    c.execute('SELECT max(seq), max(CASE WHEN keyframe THEN seq END) ' +
+              'FROM archive')
+    last, lastkey = c.fetchone()
+    keyframe = last is None or last-lastkey+1 >= ARCHIVE_KEYFRAME
+    previous = {} if keyframe else load_archived(last).boards
+    record = {'stamp': stamp, 'boards': dict(
+        (name, _archive_delta(previous.get(name, []), rows))
+        for name, rows in boards.items()
+    )}
+    data = zlib.compress(json.dumps(record, separators=(',', ':')))
+    c.execute('INSERT INTO archive(time, postid, keyframe, data) ' +
+              'VALUES(?, ?, ?, ?)',
+              (now, postid, 1 if keyframe else 0, sqlite3.Binary(data)))
+    if not dry_run:
+        db.commit()
+    logging.info("Archived leaderboard %d (%d bytes%s)", c.lastrowid,
+                 len(data), ', keyframe' if keyframe else '')
+
+def run_archive(args):
+    """List the published leaderboards in the archive."""
+
+    c.execute('SELECT seq, time, postid, keyframe, length(data) ' +
+              'FROM archive ORDER BY seq ASC')
+    for seq, now, postid, keyframe, size in c:
+        print '%6d %s %s %6d%s' % (seq, time.ctime(now), postid, size,
+                                   ' keyframe' if keyframe else '')
 
 ######################################################################
 # So long, and thanks for all the fish.
 ######################################################################
 
-def run_export(args):
-    """Export the database to JSON (output via STDOUT)."""
-
-    c.execute('SELECT circle.author, time, followers, following, betrayer, id, title, created, betrayed, audited FROM user INNER JOIN circle ON circle.author=user.author ORDER BY circle.author ASC, time ASC')
+def export_authors():
+    """Yield (author, record) pairs for the export formats, in the
+    layout of the JSON data dump."""
+    c.execute('SELECT circle.author, time, followers, following, betrayer, circle.id, title, created, betrayed, audited FROM user INNER JOIN author ON author.id=authorid INNER JOIN circle ON circle.author=name ORDER BY circle.author ASC, time ASC')
     lastauthor = None
-    authornum = 0
-    def _print_author():
-        sys.stdout.write(',\n' if authornum > 0 else '{\n')
-        json.dump(lastauthor['author'], sys.stdout)
-        del lastauthor['author']
-        sys.stdout.write(': ')
-        json.dump(lastauthor, sys.stdout, separators=(',', ':'),
-                  sort_keys=True)
-
-    for i, row in enumerate(c):
+    for row in c:
         author, time, followers, following, betrayer, postid, title, \
             created, betrayed, audited = row
         if lastauthor and author != lastauthor['author']:
-            _print_author()
+            yield lastauthor.pop('author'), lastauthor
             lastauthor = None
-            authornum += 1
         if lastauthor is None:
             lastauthor = {
                 'author': author,
@@ -1095,16 +3198,154 @@ def run_export(args):
             assert betrayer is None
         lastauthor['observations'].append((int(time), followers, following,
                                            betrayer))
+    if lastauthor:
+        yield lastauthor.pop('author'), lastauthor
+
+def write_json_export(authors, out):
+    for i, (author, data) in enumerate(authors):
+        out.write(',\n' if i > 0 else '{\n')
+        json.dump(author, out)
+        out.write(': ')
+        json.dump(data, out, separators=(',', ':'), sort_keys=True)
+    out.write('\n}')
+
+# Binary export format (all integers little-endian):
+#
+#   Header: BINARY_HEADER (magic, version, number of authors, number of
+#     observations, then the byte offsets of the author table, the four
+#     observation columns and the string table, and the string table's
+#     length)
+#   Author table: one BINARY_AUTHOR record per author (created,
+#     betrayed, audited, index of first observation, number of
+#     observations, then offset and length in the string table of the
+#     author, post ID and title, and padding)
+#   Observation columns: time (int64), followers (int32), following
+#     (int32), betrayer (int8), each with one entry per observation
+#   String table: UTF-8 strings
+#
+# Missing times are BINARY_NULL64, missing counts are BINARY_NULL32, a
+# missing betrayer flag is -1, and a missing string has length
+# BINARY_NULL_LENGTH.
+BINARY_MAGIC = 'CIRCLEDB'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<8sIIQQQQQQQQ')
+BINARY_AUTHOR = struct.Struct('<qqqQIIIIIIII')
+BINARY_NULL64 = -2**63
+BINARY_NULL32 = -2**31
+BINARY_NULL_LENGTH = 2**32-1
+
+def write_binary_export(authors, out):
+    records, strings = [], []
+    times, followers, following, betrayer = [], [], [], []
+    string_offset = [0]
+
+    def _string(data):
+        if data is None:
+            return 0, BINARY_NULL_LENGTH
+        data = data.encode('utf-8')
+        offset = string_offset[0]
+        strings.append(data)
+        string_offset[0] += len(data)
+        return offset, len(data)
+
+    def _int(val, null):
+        return null if val is None else val
+
+    for author, data in authors:
+        observations = data['observations']
+        records.append(BINARY_AUTHOR.pack(
+            _int(data['created'], BINARY_NULL64),
+            _int(data['betrayed'], BINARY_NULL64),
+            _int(data['audited'], BINARY_NULL64),
+            len(times), len(observations),
+            *(_string(author) + _string(data['id']) +
+              _string(data['title']) + (0,))))
+        for obstime, obsfollowers, obsfollowing, obsbetrayer in observations:
+            times.append(obstime)
+            followers.append(_int(obsfollowers, BINARY_NULL32))
+            following.append(_int(obsfollowing, BINARY_NULL32))
+            betrayer.append(-1 if obsbetrayer is None else int(obsbetrayer))
+
+    nobs = len(times)
+    columns = [struct.pack('<%dq' % (nobs,), *times),
+               struct.pack('<%di' % (nobs,), *followers),
+               struct.pack('<%di' % (nobs,), *following),
+               struct.pack('<%db' % (nobs,), *betrayer)]
+    offsets = [BINARY_HEADER.size]
+    offsets.append(offsets[-1] + len(records)*BINARY_AUTHOR.size)
+    for column in columns:
+        offsets.append(offsets[-1] + len(column))
+    out.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(records),
+                                 nobs, *(offsets + [string_offset[0]])))
+    for chunk in records + columns + strings:
+        out.write(chunk)
+
+def read_binary_export(buf):
+    """Yield (author, record) pairs from a binary export held in a
+    string, buffer or mmap."""
+    header = BINARY_HEADER.unpack_from(buf, 0)
+    magic, version, nauthors, nobs = header[:4]
+    authors_off, times_off, followers_off, following_off, betrayer_off, \
+        strings_off, strings_len = header[4:]
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError("Not a version %d binary export" % (BINARY_VERSION,))
+    times = struct.unpack_from('<%dq' % (nobs,), buf, times_off)
+    followers = struct.unpack_from('<%di' % (nobs,), buf, followers_off)
+    following = struct.unpack_from('<%di' % (nobs,), buf, following_off)
+    betrayer = struct.unpack_from('<%db' % (nobs,), buf, betrayer_off)
+
+    def _string(offset, length):
+        if length == BINARY_NULL_LENGTH:
+            return None
+        offset += strings_off
+        return buf[offset:offset+length].decode('utf-8')
+
+    def _int(val, null):
+        return None if val == null else val
+
+    for i in range(nauthors):
+        created, betrayed, audited, start, count, author_off, author_len, \
+            id_off, id_len, title_off, title_len, _ = \
+            BINARY_AUTHOR.unpack_from(buf, authors_off+i*BINARY_AUTHOR.size)
+        yield _string(author_off, author_len), {
+            'created': _int(created, BINARY_NULL64),
+            'betrayed': _int(betrayed, BINARY_NULL64),
+            'audited': _int(audited, BINARY_NULL64),
+            'id': _string(id_off, id_len),
+            'title': _string(title_off, title_len),
+            'observations': [
+                (times[j], _int(followers[j], BINARY_NULL32),
+                 _int(following[j], BINARY_NULL32),
+                 None if betrayer[j] == -1 else bool(betrayer[j]))
+                for j in range(start, start+count)
+            ],
+        }
+
+def run_export(args):
+    """Export the database to JSON or binary (output via STDOUT)."""
+
+    if args.format == 'binary':
+        write_binary_export(export_authors(), sys.stdout)
     else:
-        if lastauthor:
-            _print_author()
-    sys.stdout.write('\n}')
+        write_json_export(export_authors(), sys.stdout)
 
 def run_import(args):
-    """Import to the database from JSON (input via STDIN)."""
+    """Import to the database from JSON or binary (input via STDIN or
+    the given file)."""
+
+    infile = open(args.file, 'rb') if args.file else sys.stdin
+    if args.format == 'binary':
+        if args.file:
+            import mmap
+            buf = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            buf = infile.read()
+        authors = read_binary_export(buf)
+    else:
+        authors = json.load(infile).items()
 
     count = 0
-    for user, data in json.load(sys.stdin).items():
+    for user, data in authors:
         n = observe_circle(data['id'], user, data['title'],
                            data['created'], data['betrayed'], data['audited'])
         assert n == 1
@@ -1115,16 +3356,698 @@ def run_import(args):
         count += n-1
     save(args, count)
 
+def run_backfill_peaks(args):
+    """Recompute the peak number of circles joined by each user."""
+
+    c.execute('SELECT name, following, time FROM user ' +
+              'INNER JOIN author ON author.id == authorid ' +
+              'WHERE following NOT NULL ' +
+              'ORDER BY authorid ASC, following DESC, time ASC')
+    peaks = []
+    for author, following, obstime in c.fetchall():
+        if not peaks or peaks[-1][0].lower() != author.lower():
+            peaks.append((author, following, obstime))
+    c.execute('DELETE FROM peak')
+    c.executemany('INSERT INTO peak(author, following, time) ' +
+                  'VALUES(?, ?, ?)', peaks)
+    save(args, len(peaks))
+
+
+######################################################################
+# ANALYSIS
+######################################################################
+
+ANALYSIS_CACHE = 'analysis-cache.npz'   # Default cache of loaded arrays
+ANALYSIS_QUANTILES = (10, 25, 50, 75, 90)
+
+def load_analysis_arrays(np, cache_file=None):
+    """Load the user and circle tables into NumPy arrays, reusing the
+    cache file if the database has no newer observations."""
+    c.execute('SELECT max(time), max(rowid) FROM user')
+    key = np.array(c.fetchone(), dtype=float)
+    if cache_file and os.path.exists(cache_file):
+        cached = np.load(cache_file)
+        if np.array_equal(cached['key'], key):
+            logging.info("Loaded arrays from %s", cache_file)
+            return dict((k, cached[k]) for k in cached.files)
+
+    authors, authorids = [], {}
+    def _authorid(author):
+        key = author.lower()
+        if key not in authorids:
+            authorids[key] = len(authors)
+            authors.append(author)
+        return authorids[key]
+
+    c.execute('SELECT name, time, followers, following, betrayer ' +
+              'FROM user INNER JOIN author ON author.id == authorid ' +
+              'ORDER BY name ASC, time ASC')
+    rows = c.fetchall()
+    obs_author = np.array([_authorid(row[0]) for row in rows], dtype=np.int32)
+    # Betrayer is '' (not a betrayer) for flair without the mark, and
+    # unknown values (None) become NaN
+    obs = np.array([row[1:4] + (None if row[4] is None else bool(row[4]),)
+                    for row in rows], dtype=float).reshape(-1, 4)
+
+    c.execute('SELECT author, id NOT NULL, created, betrayed, audited ' +
+              'FROM circle')
+    circle_rows = [(_authorid(row[0]),) + row[1:] for row in c.fetchall()]
+    circles = np.full((len(authors), 4), np.nan)
+    if circle_rows:
+        circle_rows = np.array(circle_rows, dtype=float)
+        circles[circle_rows[:, 0].astype(int)] = circle_rows[:, 1:]
+    # Missing circles and unknown times are stored as NaN
+    circles[:, 1:][circles[:, 1:] == 0] = np.nan
+
+    arrays = {
+        'authors': np.array(authors, dtype=np.unicode_),
+        'has_post': circles[:, 0] == 1,
+        'created': circles[:, 1],
+        'betrayed': circles[:, 2],
+        'audited': circles[:, 3],
+        'obs_author': obs_author,
+        'obs_time': obs[:, 0],
+        'obs_followers': obs[:, 1],
+        'obs_following': obs[:, 2],
+        'obs_betrayer': obs[:, 3],
+    }
+    if cache_file:
+        # Through a file, since np.savez adds .npz to names without it
+        with open(cache_file, 'wb') as f:
+            np.savez(f, key=key, **arrays)
+        logging.info("Saved arrays to %s", cache_file)
+    return arrays
+
+def _quantiles(np, values):
+    if not len(values):
+        return None
+    return dict(('p%d' % (q,), float(v)) for q, v in
+                zip(ANALYSIS_QUANTILES,
+                    np.percentile(values, ANALYSIS_QUANTILES)))
+
+def analyze_growth(np, a, bin_size=ONE_HOUR):
+    """Mean and maximum observed circle size by circle age."""
+    age = a['obs_time'] - a['created'][a['obs_author']]
+    followers = a['obs_followers']
+    ok = ~np.isnan(age) & ~np.isnan(followers) & (age >= 0)
+    bins = (age[ok] // bin_size).astype(int)
+    if not len(bins):
+        return []
+    counts = np.bincount(bins)
+    sums = np.bincount(bins, weights=followers[ok])
+    maxima = np.zeros(len(counts))
+    np.maximum.at(maxima, bins, followers[ok])
+    return [{'age': int(i*bin_size), 'observations': int(counts[i]),
+             'mean': sums[i]/counts[i], 'max': maxima[i]}
+            for i in np.nonzero(counts)[0]]
+
+def analyze_betrayal(np, a):
+    """Distribution of time from circle creation to observed betrayal."""
+    lifetime = a['betrayed'] - a['created']
+    lifetime = lifetime[~np.isnan(lifetime) & (lifetime >= 0)]
+    return {'circles': int(np.count_nonzero(~np.isnan(a['created']))),
+            'betrayed': len(lifetime),
+            'lifetime': _quantiles(np, lifetime)}
+
+def analyze_velocity(np, a, bin_size=ONE_HOUR):
+    """Circles joined per hour (all users) and per user."""
+    same = a['obs_author'][1:] == a['obs_author'][:-1]
+    joined = np.diff(a['obs_following'])
+    elapsed = np.diff(a['obs_time'])
+    ok = same & (joined > 0)    # NaN compares false
+    bins = ((a['obs_time'][1:][ok] - CIRCLE_RESET_TIME) // bin_size)
+    bins = np.maximum(bins, 0).astype(int)
+    per_hour = np.bincount(bins, weights=joined[ok])
+
+    # Per-user rate over each user's observed span
+    ok = same & ~np.isnan(joined)
+    users = a['obs_author'][1:][ok]
+    total = np.bincount(users, weights=np.maximum(joined[ok], 0))
+    span = np.bincount(users, weights=elapsed[ok])
+    rate = total[span > 0] / span[span > 0] * ONE_HOUR
+    return {'by_hour': [{'time': int(CIRCLE_RESET_TIME + i*bin_size),
+                         'joined': int(n)} for i, n in enumerate(per_hour)],
+            'per_user_hourly': _quantiles(np, rate)}
+
+def analyze_distribution(np, a):
+    """Joint distribution of each user's latest followers and following,
+    in power-of-two buckets."""
+    n = len(a['obs_author'])
+    if not n:
+        return {'users': 0}
+    last = np.append(np.nonzero(a['obs_author'][1:] !=
+                                a['obs_author'][:-1])[0], n-1)
+    followers = a['obs_followers'][last]
+    following = a['obs_following'][last]
+    ok = ~np.isnan(followers) & ~np.isnan(following)
+    x = np.floor(np.log2(1 + followers[ok])).astype(int)
+    y = np.floor(np.log2(1 + following[ok])).astype(int)
+    counts = np.zeros((x.max()+1, y.max()+1), dtype=int) if len(x) else \
+             np.zeros((0, 0), dtype=int)
+    np.add.at(counts, (x, y), 1)
+    corr = np.corrcoef(np.log1p(followers[ok]), np.log1p(following[ok]))
+    return {'users': int(np.count_nonzero(ok)),
+            'log_correlation': float(corr[0, 1]) if len(x) > 1 else None,
+            'buckets': [{'followers': 2**i-1, 'following': 2**j-1,
+                         'users': int(counts[i, j])}
+                        for i, j in zip(*np.nonzero(counts))]}
+
+def run_analyze(args):
+    """Compute aggregate statistics over the observation history."""
+
+    import numpy as np
+
+    arrays = load_analysis_arrays(np, None if args.no_cache else args.cache)
+    with np.errstate(invalid='ignore'):     # Comparisons with NaN
+        report = {
+            'growth': analyze_growth(np, arrays),
+            'betrayal': analyze_betrayal(np, arrays),
+            'velocity': analyze_velocity(np, arrays),
+            'distribution': analyze_distribution(np, arrays),
+        }
+    if args.json:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        print
+        return
+
+    print "Circle size by age:"
+    for row in report['growth']:
+        print "  %6s %8d obs  mean %7.1f  max %4d" % (
+            format_lifetime(row['age']), row['observations'], row['mean'],
+            row['max'])
+    print
+    betrayal = report['betrayal']
+    print "Betrayed circles: %d of %d" % (betrayal['betrayed'],
+                                          betrayal['circles'])
+    if betrayal['lifetime']:
+        print "  Time to betrayal: " + '  '.join(
+            '%s %s' % (k, format_lifetime(v))
+            for k, v in sorted(betrayal['lifetime'].items()))
+    print
+    velocity = report['velocity']
+    print "Circles joined per hour (PDT):"
+    for row in velocity['by_hour']:
+        # Circle ran entirely within PDT (UTC-7)
+        print "  %s %7d" % (time.strftime('%a %H:%M', time.gmtime(
+            row['time'] - 7*ONE_HOUR)), row['joined'])
+    if velocity['per_user_hourly']:
+        print "  Per user: " + '  '.join(
+            '%s %.2f' % (k, v)
+            for k, v in sorted(velocity['per_user_hourly'].items()))
+    print
+    distribution = report['distribution']
+    print "Followers vs. following (%d users, log correlation %s):" % (
+        distribution['users'], '%.3f' % (distribution['log_correlation'],)
+        if distribution.get('log_correlation') is not None else 'n/a')
+    for row in distribution.get('buckets', []):
+        print "  followers >= %4d  following >= %4d  %6d users" % (
+            row['followers'], row['following'], row['users'])
+
+######################################################################
+# QUERY SERVICE
+######################################################################
+
+SERVE_REFRESH = 30              # Seconds between index refreshes
+SERVE_CACHE_SIZE = 1024         # Maximum number of cached responses
+SERVE_PAGE_LENGTH = 25          # Default leaderboard page length
+SERVE_MAX_PAGE_LENGTH = 1000    # Maximum leaderboard page length
+SERVE_BOARDS = ('active', 'betrayed', 'users')
+
+class LeaderboardIndex(object):
+    """In-memory copy of the circle and user tables for the query
+    service, refreshed incrementally from the database."""
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.refreshed = None
+        self.circles = {}       # Lowercased author -> circle row
+        self.peaks = {}         # Lowercased author -> peak following
+        self.series = {}        # Lowercased author -> observations
+        self._rankings = {}
+        self._last_rowid = 0
+        self._data_version = None
+        self._db = None
+
+    def refresh(self):
+        """Load observations added since the last refresh. Returns True
+        if the index changed."""
+        if self._db is None:
+            self._db = sqlite3.connect(self.dbfile, check_same_thread=False)
+        cur = self._db.cursor()
+        cur.execute('PRAGMA data_version')
+        data_version = cur.fetchone()[0]
+        if data_version == self._data_version:
+            return False
+
+        cur.execute('SELECT user.rowid, time, name, followers, following, ' +
+                    'betrayer FROM user ' +
+                    'INNER JOIN author ON author.id == authorid ' +
+                    'WHERE user.rowid > ? ORDER BY user.rowid ASC',
+                    (self._last_rowid,))
+        rows = cur.fetchall()
+        # The circle table is small, and its rows are updated in place
+        cur.execute('SELECT author, id, title, created, betrayed, audited ' +
+                    'FROM circle')
+        circles = dict((row[0].lower(), row) for row in cur)
+        cur.execute('SELECT author, following FROM peak')
+        peaks = dict((row[0].lower(), row[1]) for row in cur)
+
+        with self.lock:
+            for row in rows:
+                series = self.series.setdefault(row[2].lower(), [])
+                observation = row[1:2] + row[3:]
+                if series and series[-1][0] > observation[0]:
+                    # Out-of-order observation (e.g. from an import)
+                    i = bisect.bisect_right([x[0] for x in series],
+                                            observation[0])
+                    series.insert(i, observation)
+                else:
+                    series.append(observation)
+            if rows:
+                self._last_rowid = rows[-1][0]
+            self.circles = circles
+            self.peaks = peaks
+            self._rankings = {}
+            self._data_version = data_version
+            self.generation += 1
+            self.refreshed = time.time()
+        logging.info("Index refreshed: %d new observations (generation %d)",
+                     len(rows), self.generation)
+        return True
+
+    def _rank(self, board):
+        leaders = []
+        for key, series in self.series.iteritems():
+            circle = self.circles.get(key)
+            if not circle:
+                continue
+            author, postid, title, created, betrayed, audited = circle
+            _, followers, following, betrayer = series[-1]
+            if board == 'users':
+                leaders.append((author, followers, following, betrayer,
+                                self.peaks.get(key)))
+                continue
+            if not postid or bool(betrayed) != (board == 'betrayed'):
+                continue
+            leaders.append((author, followers, following, betrayer,
+                            postid, title, betrayed, created))
+        # Same orderings as get_leaders and get_following_leaders
+        # (SQLite sorts NULL below any number)
+        if board == 'users':
+            leaders.sort(key=lambda r: (r[2] is None, -(r[2] or 0),
+                                        r[1] is None, -(r[1] or 0)))
+        else:
+            leaders.sort(key=lambda r: (r[1] is None, -(r[1] or 0), r[7]))
+        return leaders
+
+    def leaders(self, board, offset=0, length=SERVE_PAGE_LENGTH):
+        """Return the total length of a leaderboard and the requested
+        page, in the row format of get_leaders (or
+        get_following_leaders, for the users board)."""
+        with self.lock:
+            if board not in self._rankings:
+                self._rankings[board] = self._rank(board)
+            leaders = self._rankings[board]
+            return len(leaders), leaders[offset:offset+length]
+
+    def lookup(self, author, since=None, until=None):
+        """Return the circle row and observations (optionally limited to
+        a time range) for an author."""
+        with self.lock:
+            key = author.lower()
+            circle = self.circles.get(key)
+            series = self.series.get(key)
+        if series is None:
+            return circle, None
+        times = [x[0] for x in series]
+        lo = bisect.bisect_left(times, since) if since is not None else 0
+        hi = bisect.bisect_right(times, until) if until is not None \
+             else len(series)
+        return circle, series[lo:hi]
+
+def _circle_json(circle):
+    if not circle:
+        return None
+    author, postid, title, created, betrayed, audited = circle
+    return {'id': postid, 'title': title, 'created': created,
+            'betrayed': betrayed, 'audited': audited}
+
+def _leader_json(board, rank, row):
+    anonymous = row[0].lower() in get_config()['anonymize']
+    entry = {
+        'rank': rank,
+        'author': None if anonymous else row[0],
+        'followers': row[1],
+        'following': row[2],
+        'betrayer': None if row[3] is None else bool(row[3]),
+    }
+    if board == 'users':
+        entry['peak'] = row[4]
+    else:
+        postid, title, betrayed, created = row[4:8]
+        entry.update({'id': None if anonymous else postid,
+                      'title': None if anonymous else title,
+                      'betrayed': betrayed, 'created': created})
+        if board == 'growing':
+            entry['gained'] = row[8]
+            # Not recorded by archives from before it was added
+            entry['following_gained'] = row[9] if len(row) > 9 else None
+    return entry
+
+def serve_query(index, path, query):
+    """Answer one query against the index. Returns an HTTP status code
+    and a JSON-serializable object."""
+    parts = [urllib.unquote(x) for x in path.strip('/').split('/')]
+
+    def _number(name, default=None, kind=float):
+        if name not in query:
+            return default
+        return kind(query[name][-1])
+
+    if parts == ['status']:
+        return 200, {'generation': index.generation,
+                     'refreshed': index.refreshed,
+                     'authors': len(index.series),
+                     'circles': len(index.circles)}
+
+    if len(parts) == 2 and parts[0] == 'leaderboard':
+        board = parts[1]
+        if board not in SERVE_BOARDS:
+            return 404, {'error': 'unknown leaderboard'}
+        offset = max(0, _number('offset', 0, int))
+        length = min(max(0, _number('length', SERVE_PAGE_LENGTH, int)),
+                     SERVE_MAX_PAGE_LENGTH)
+        total, leaders = index.leaders(board, offset, length)
+        return 200, {'board': board, 'total': total, 'offset': offset,
+                     'generation': index.generation,
+                     'entries': [_leader_json(board, offset+i+1, row)
+                                 for i, row in enumerate(leaders)]}
+
+    if len(parts) == 2 and parts[0] in ('user', 'chart'):
+        author = parts[1]
+        if author.lower() in get_config()['anonymize']:
+            return 404, {'error': 'unknown user'}
+        circle, series = index.lookup(author, _number('since'),
+                                      _number('until'))
+        if series is None:
+            return 404, {'error': 'unknown user'}
+        if parts[0] == 'user':
+            return 200, {'author': circle[0] if circle else author,
+                         'circle': _circle_json(circle),
+                         'observations': series}
+
+        end_time = CIRCLE_ENDED if CIRCLE_ENDED else None
+        if query.get('series', ['followers'])[-1] == 'following':
+            points = [(x[0], x[2], x[3]) for x in series]
+            url = make_plot(points, author, created=CIRCLE_RESET_TIME,
+                            title_prefix='Joined: ', with_timestamp=False,
+                            betrayer=first_betrayal(points), now=end_time) \
+                  if points else None
+        else:
+            points = [(x[0], x[1]) for x in series]
+            if not circle:
+                return 404, {'error': 'no circle for user'}
+            created, betrayed, audited = circle[3:6]
+            url = make_plot(points, author, created, betrayed, audited,
+                            title_prefix='Circle: ', now=end_time) \
+                  if points else None
+        return 200, {'author': circle[0] if circle else author,
+                     'points': [x[:2] for x in points], 'url': url}
+
+    return 404, {'error': 'not found'}
+
+def run_serve(args):
+    """Serve leaderboards and user histories as JSON over HTTP."""
+
+    import BaseHTTPServer
+    import SocketServer
+    import urlparse
+
+    index = LeaderboardIndex(get_config()["dbfile"])
+    index.refresh()
+    cache = OrderedDict()
+    cache_lock = threading.Lock()
+
+    class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            generation = index.generation
+            with cache_lock:
+                cached = cache.pop(self.path, None)
+                if cached and cached[0] == generation:
+                    cache[self.path] = cached
+                    status, body = cached[1:]
+                else:
+                    cached = None
+            if not cached:
+                url = urlparse.urlsplit(self.path)
+                try:
+                    status, obj = serve_query(index, url.path,
+                                              urlparse.parse_qs(url.query))
+                except ValueError:
+                    status, obj = 400, {'error': 'bad request'}
+                body = json.dumps(obj, separators=(',', ':'))
+                with cache_lock:
+                    cache[self.path] = (generation, status, body)
+                    while len(cache) > SERVE_CACHE_SIZE:
+                        cache.popitem(last=False)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'max-age=%d' % (args.refresh,))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("%s %s", self.address_string(), format % args)
+
+    class QueryServer(SocketServer.ThreadingMixIn,
+                      BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    def _refresh_loop():
+        while True:
+            time.sleep(args.refresh)
+            try:
+                index.refresh()
+            except Exception as e:
+                logging.exception(e)
+
+    refresher = threading.Thread(target=_refresh_loop)
+    refresher.daemon = True
+    refresher.start()
+
+    server = QueryServer((args.host, args.port), QueryHandler)
+    logging.info("Serving on %s:%d", args.host, args.port)
+    server.serve_forever()
+
+
+######################################################################
+# CHANGE FEED
+######################################################################
+
+FEED_SEGMENT_SIZE = 16*1024*1024 # Bytes in a feed file before rotating
+FEED_SEGMENTS = 8               # Feed files kept
+FEED_POLL = 1                   # Seconds between checks with tail --follow
+
+# Each row written by observe_circle, observe_missing_circle and
+# observe_user is staged in the changes table, in the same transaction,
+# when change_feed_dir is set in config.json. AUTOINCREMENT numbers the
+# changes in commit order, even with several processes writing. Once
+# committed, save() appends them to the feed, one JSON object per line,
+# in files named by their first sequence number.
+
+_staged = 0                     # Changes staged since the last publish
+
+def feed_dir():
+    return get_config().get('change_feed_dir')
+
+def stage_change(record):
+    global _staged
+    if not feed_dir():
+        return
+    c.execute('INSERT INTO changes(data) VALUES(?)',
+              (json.dumps(record, separators=(',', ':'), sort_keys=True),))
+    _staged += 1
+
+def stage_circle_change(column, value):
+    """Stage the current state of a circle, as just written."""
+    if not feed_dir():
+        return
+    c.execute(('SELECT id, author, title, created, betrayed, audited ' +
+               'FROM circle WHERE %s=?') % (column,), (value,))
+    row = c.fetchone()
+    stage_change(dict(zip(('id', 'author', 'title', 'created', 'betrayed',
+                           'audited'), row), table='circle'))
+
+def feed_segments(directory):
+    """Return the first sequence number and path of each feed file,
+    oldest first."""
+    segments = []
+    for name in os.listdir(directory):
+        match = re.match(r'^changes-(\d+)\.jsonl$', name)
+        if match:
+            segments.append((int(match.group(1)),
+                             os.path.join(directory, name)))
+    segments.sort()
+    return segments
+
+def _last_feed_seq(segments):
+    """Return the sequence number of the last complete line in the feed
+    (cutting off any partly-written line)."""
+    if not segments:
+        return 0
+    first, path = segments[-1]
+    with open(path, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - 65536))
+        tail = f.read()
+        end = tail.rfind('\n') + 1
+        if end < len(tail):
+            logging.warning("Removing partial line from %s", path)
+            f.truncate(size - len(tail) + end)
+        lines = tail[:end].splitlines()
+    if not lines:
+        return first - 1
+    return json.loads(lines[-1])['seq']
+
+def publish_changes():
+    """Append the committed changes to the change feed, rotating its
+    files, and remove them from the changes table."""
+    global _staged
+    import fcntl
+    directory = feed_dir()
+    if not directory or not _staged:
+        return
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, '.lock'), 'a') as lock:
+        # Another process may be publishing the same changes
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        segments = feed_segments(directory)
+        last = _last_feed_seq(segments)
+        c.execute('SELECT seq, data FROM changes WHERE seq > ? ' +
+                  'ORDER BY seq ASC', (last,))
+        rows = c.fetchall()
+        out = None
+        try:
+            for seq, data in rows:
+                if out is None or out.tell() >= FEED_SEGMENT_SIZE:
+                    if out is not None:
+                        out.close()
+                    if segments and \
+                       os.path.getsize(segments[-1][1]) < FEED_SEGMENT_SIZE:
+                        path = segments[-1][1]
+                    else:
+                        path = os.path.join(directory,
+                                            'changes-%012d.jsonl' % (seq,))
+                        segments.append((seq, path))
+                    out = open(path, 'ab')
+                # Sequence number first, for readers that only need it
+                out.write('{"seq":%d,%s\n' % (seq, data[1:]))
+                last = seq
+            if out is not None:
+                out.flush()
+                os.fsync(out.fileno())
+        finally:
+            if out is not None:
+                out.close()
+        for first, path in segments[:-FEED_SEGMENTS]:
+            os.remove(path)
+        # Changes already in the feed (from a process that stopped
+        # before removing them) are also removed
+        c.execute('DELETE FROM changes WHERE seq <= ?', (last,))
+        db.commit()
+    _staged = 0
+    if rows:
+        logging.info("Published %d changes (to %d)", len(rows), last)
+
+def run_tail(args):
+    """Print the change feed from after the given sequence number."""
+
+    directory = feed_dir()
+    if not directory:
+        logging.error("No change_feed_dir in config.json")
+        return
+    after = args.after
+    position = None             # File name and offset being read
+    while True:
+        segments = feed_segments(directory) \
+                   if os.path.isdir(directory) else []
+        if position is None:
+            # The file holding the next change, if any
+            start = [x for x in segments if x[0] <= after+1]
+            if segments and not start:
+                logging.error("Changes after %d are no longer in the feed " +
+                              "(it starts at %d)", after, segments[0][0])
+                return
+            if start:
+                position = (start[-1][1], 0)
+        while position:
+            path, offset = position
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read()
+            except IOError:
+                logging.error("%s was rotated away before it was read " +
+                              "(after %d)", path, after)
+                return
+            # Only complete lines
+            data = data[:data.rfind('\n')+1]
+            for line in data.splitlines(True):
+                # Lines start with their sequence number
+                seq = int(line[len('{"seq":'):line.index(',')])
+                if seq > after:
+                    sys.stdout.write(line)
+                    after = seq
+            position = (path, offset + len(data))
+            later = [x[1] for x in segments if x[1] > path]
+            if not data and later:
+                position = (later[0], 0)
+            elif not data:
+                break
+        sys.stdout.flush()
+        if not args.follow:
+            return
+        time.sleep(FEED_POLL)
 
 ######################################################################
 # MAIN FUNCTION
 ######################################################################
 
+def run_profiled(args):
+    import cProfile
+    import pstats
+    global c
+    c = TracingCursor(c)
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(args.func, args)
+    finally:
+        # Also report on daemons stopped with Ctrl-C
+        profiler.dump_stats(args.profile)
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        stats.sort_stats('cumulative').print_stats(30)
+        c.report(sys.stderr, args.slow_query)
+        logging.info("Profile saved to %s", args.profile)
+
 def main(args):
     # Main argument parser
     parser = argparse.ArgumentParser()
     parser.add_argument('--dry-run', '--no-act', action='store_true',
                         help="Dry-run, don't update DB")
+    parser.add_argument('--timing', action='store_true',
+                        help="Log startup and subcommand run times")
+    parser.add_argument('--profile', metavar='FILE', action='store',
+                        help="Profile the subcommand, saving the statistics "
+                        "in FILE and reporting hot spots and SQL statements")
+    parser.add_argument('--slow-query', metavar='SECONDS', type=float,
+                        default=SLOW_QUERY,
+                        help="With --profile, show the query plan of "
+                        "statements slower than this")
     subparsers = parser.add_subparsers(title='subcommands')
 
     # "daemon" subcommand
@@ -1136,7 +4059,14 @@ def main(args):
                             help="Don't observe post listings.")
     parser_dmn.add_argument('--audit-density', default=1,
                             action='store', type=int,
-                            help="Don't observe post listings.")
+                            help="Users audited between reads of the "
+                            "comment stream.")
+    parser_dmn.add_argument('--audit-batch', default=DAEMON_AUDIT_BATCH,
+                            action='store', type=int,
+                            help="Users audited per iteration, whose posts "
+                            "are looked up together.")
+    parser_dmn.add_argument('--queue', action='store_true',
+                            help="Share work with other daemons.")
     parser_dmn.set_defaults(func=run_daemon)
 
 
@@ -1195,6 +4125,14 @@ def main(args):
                             help="Number of audits to perform.")
     parser_adt.set_defaults(func=run_audit)
 
+    # "subscribe" subcommand
+    parser_sub = subparsers.add_parser('subscribe',
+                                       help=run_subscribe.__doc__)
+    parser_sub.add_argument('count', action='store', type=int,
+                            default=SUBSCRIBE_COUNT, nargs='?',
+                            help="Number of top circles to follow.")
+    parser_sub.set_defaults(func=run_subscribe)
+
     # "leaderboard" subcommand
     parser_brd = subparsers.add_parser('leaderboard',
                                        help=run_leaderboard.__doc__)
@@ -1202,23 +4140,109 @@ def main(args):
                             help="Update given post ID.")
     parser_brd.add_argument('--full-urls', action='store_true',
                             help="Use full URLs for user links.")
+    parser_brd.add_argument('--svg-dir', metavar='DIR', action='store',
+                            help="Render charts as SVG files in DIR.")
+    parser_brd.add_argument('--as-of', metavar='TIME', type=parse_time,
+                            help="Show the leaderboards as they were at TIME "
+                            "(timestamp or 'YYYY-MM-DD HH:MM' PDT).")
+    parser_brd.add_argument('--until', metavar='TIME', type=parse_time,
+                            help="With --as-of, write leaderboards from "
+                            "--as-of until TIME.")
+    parser_brd.add_argument('--every', metavar='SECONDS', type=int,
+                            default=ONE_HOUR,
+                            help="Time between leaderboards with --until.")
+    parser_brd.add_argument('--snapshot-dir', metavar='DIR', default='.',
+                            help="Directory for leaderboards with --until.")
+    parser_brd.add_argument('--archived', metavar='SEQ', type=int,
+                            help="Show a published leaderboard from the "
+                            "archive.")
+    parser_brd.add_argument('--output-dir', metavar='DIR',
+                            help="Write each leaderboard to DIR as Markdown "
+                            "and HTML files instead.")
+    parser_brd.add_argument('--json', action='store_true',
+                            help="With --output-dir, also write JSON files.")
+    parser_brd.add_argument('--csv', action='store_true',
+                            help="With --output-dir, also write CSV files.")
     parser_brd.add_argument('length', action='store', type=int, default=None,
                             nargs='?',
                             help="Return leaderboards of given length.")
     parser_brd.set_defaults(func=run_leaderboard)
 
+    # "archive" subcommand
+    parser_arc = subparsers.add_parser('archive',
+                                       help=run_archive.__doc__)
+    parser_arc.set_defaults(func=run_archive)
+
     # "export" subcommand
     parser_exp = subparsers.add_parser('export',
                                        help=run_export.__doc__)
+    parser_exp.add_argument('--format', choices=('json', 'binary'),
+                            default='json', help="Output format.")
     parser_exp.set_defaults(func=run_export)
 
     # "import" subcommand
     parser_imp = subparsers.add_parser('import',
                                        help=run_import.__doc__)
+    parser_imp.add_argument('--format', choices=('json', 'binary'),
+                            default='json', help="Input format.")
+    parser_imp.add_argument('file', nargs='?',
+                            help="File to import (instead of STDIN)")
     parser_imp.set_defaults(func=run_import)
 
+    # "backfill-peaks" subcommand
+    parser_bfp = subparsers.add_parser('backfill-peaks',
+                                       help=run_backfill_peaks.__doc__)
+    parser_bfp.set_defaults(func=run_backfill_peaks)
+
+    # "analyze" subcommand
+    parser_anl = subparsers.add_parser('analyze',
+                                       help=run_analyze.__doc__)
+    parser_anl.add_argument('--json', action='store_true',
+                            help="Output the results as JSON.")
+    parser_anl.add_argument('--cache', metavar='FILE', action='store',
+                            default=ANALYSIS_CACHE,
+                            help="Cache loaded arrays in the given file.")
+    parser_anl.add_argument('--no-cache', action='store_true',
+                            help="Don't read or write the array cache.")
+    parser_anl.set_defaults(func=run_analyze)
+
+    # "serve" subcommand
+    parser_srv = subparsers.add_parser('serve',
+                                       help=run_serve.__doc__)
+    parser_srv.add_argument('--host', action='store', default='127.0.0.1',
+                            help="Address to listen on.")
+    parser_srv.add_argument('--port', action='store', type=int, default=8080,
+                            help="Port to listen on.")
+    parser_srv.add_argument('--refresh', metavar='SECONDS', action='store',
+                            type=int, default=SERVE_REFRESH,
+                            help="Seconds between database refreshes.")
+    parser_srv.set_defaults(func=run_serve)
+
+    # "tail" subcommand
+    parser_tal = subparsers.add_parser('tail',
+                                       help=run_tail.__doc__)
+    parser_tal.add_argument('--after', metavar='SEQ', action='store',
+                            type=int, default=0,
+                            help="Start after the given sequence number "
+                            "(the last one processed).")
+    parser_tal.add_argument('--follow', '-f', action='store_true',
+                            help="Keep printing changes as they are "
+                            "published.")
+    parser_tal.set_defaults(func=run_tail)
+
     args = parser.parse_args(args)
-    args.func(args)
+    open_db()
+    ready_time = time.time()
+    if args.timing:
+        logging.info("Startup took %.3f seconds (%.3f in imports)",
+                     ready_time - _START_TIME, _IMPORTED_TIME - _START_TIME)
+    if args.profile:
+        run_profiled(args)
+    else:
+        args.func(args)
+    if args.timing:
+        logging.info("Subcommand %s took %.3f seconds", args.func.__name__,
+                     time.time() - ready_time)
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -0,0 +1,391 @@
+#!/usr/bin/env python2
+#
+# Usage: ./reddit-standin.py [--port PORT] [--db circle.db]
+#
+# Minimal stand-in for the parts of the Reddit API used by circle.py,
+# serving the circles and users in a circle.py database, for testing.
+# Set both oauth_url and reddit_url to http://localhost:PORT in
+# config.json (with a copy of the database as dbfile, since the
+# stand-in reads from the database given here). Databases from before
+# the author table need to be opened by circle.py once, to migrate them.
+# Every client ID and password is accepted.
+#
+# Each client ID gets its own rate limit window, reported in the
+# X-Ratelimit-* response headers like Reddit does. GET /_stats returns
+# the number of requests made with each client ID. With --fail-rate,
+# some requests get a 503 response.
+#
+# The circle websockets in the embed config are served too. Each pushes
+# the circle's size every --ws-interval seconds, as the circle gains a
+# member (or is betrayed, with --ws-betray), and drops the connection
+# with --ws-drop.
+
+import argparse
+import base64
+import cgi
+import hashlib
+import json
+import logging
+import random
+import re
+import socket
+import sqlite3
+import struct
+import threading
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from collections import Counter
+
+logging.basicConfig(
+    format='[%(asctime)s] %(levelname)s %(name)s: %(message)s',
+    level=logging.INFO
+)
+
+SUBREDDIT = 'CircleofTrust'
+BETRAY_SYMBOL = u'\u2205'   # Empty set
+RATE_WINDOW = 600               # Seconds in each rate limit window
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+class Standin(object):
+    """The data served by the stand-in, loaded from a circle.py
+    database."""
+
+    def __init__(self, dbfile, rate_limit, churn):
+        self.lock = threading.Lock()
+        self.rate_limit = rate_limit
+        self.churn = churn
+        self.requests = Counter()
+        self.windows = {}       # Client ID -> (window start, requests)
+        self.edits = {}
+        self.ws_base = None
+
+        db = sqlite3.connect(dbfile)
+        c = db.cursor()
+        self.users = {}
+        c.execute('SELECT name, followers, following, betrayer, time ' +
+                  'FROM user INNER JOIN author ON author.id == authorid ' +
+                  'ORDER BY time ASC, user.rowid ASC')
+        for author, followers, following, betrayer, obstime in c:
+            self.users[author.lower()] = {
+                'name': author, 'followers': followers or 0,
+                'following': following or 0, 'betrayer': bool(betrayer),
+                'time': obstime,
+            }
+        self.posts = {}
+        c.execute('SELECT id, author, title, created, betrayed FROM circle ' +
+                  'WHERE id NOT NULL')
+        for postid, author, title, created, betrayed in c:
+            if author.lower() in self.users:
+                self.posts[postid] = {'id': postid, 'author': author,
+                                      'title': title, 'created': created,
+                                      'betrayed': bool(betrayed)}
+        self.circles = dict((x['author'].lower(), x)
+                            for x in self.posts.values())
+        db.close()
+        logging.info("Loaded %d users and %d circles", len(self.users),
+                     len(self.posts))
+
+    def count(self, client):
+        """Count a request from the given client, returning the rate
+        limit headers (or None if the client is over its limit)."""
+        with self.lock:
+            now = time.time()
+            start, used = self.windows.get(client, (now, 0))
+            if now - start >= RATE_WINDOW:
+                start, used = now, 0
+            used += 1
+            self.windows[client] = (start, used)
+            self.requests[client] += 1
+            if self.churn and random.random() < self.churn:
+                user = random.choice(self.users.values())
+                user['followers'] += 1
+                user['time'] = now
+        headers = {
+            'X-Ratelimit-Used': str(used),
+            'X-Ratelimit-Remaining': str(max(0, self.rate_limit-used)),
+            'X-Ratelimit-Reset': str(int(start + RATE_WINDOW - now)),
+        }
+        return headers if used <= self.rate_limit else None
+
+    def flair(self, author):
+        user = self.users.get(author.lower())
+        if not user:
+            return None
+        return u'%d, %d%s' % (user['followers'], user['following'],
+                              ' ' + BETRAY_SYMBOL if user['betrayer']
+                              else '')
+
+    def post_json(self, post):
+        return {'kind': 't3', 'data': {
+            'id': post['id'], 'name': 't3_' + post['id'],
+            'author': post['author'], 'title': post['title'],
+            'created_utc': post['created'],
+            'url': 'https://www.reddit.com/user/%s/circle/embed/' %
+                   (post['author'],),
+            'permalink': '/r/%s/comments/%s/' % (SUBREDDIT, post['id']),
+            'subreddit': SUBREDDIT,
+            'link_flair_text': 'Betrayed' if post['betrayed'] else None,
+            'author_flair_text': self.flair(post['author']),
+        }}
+
+    def comment_json(self, user):
+        commentid = 'c%x' % (abs(hash(user['name'])) % 16**6,)
+        return {'kind': 't1', 'data': {
+            'id': commentid, 'name': 't1_' + commentid,
+            'author': user['name'], 'body': 'Join my circle',
+            'created_utc': user['time'], 'subreddit': SUBREDDIT,
+            'link_id': 't3_000000', 'parent_id': 't3_000000',
+            'author_flair_text': self.flair(user['name']),
+        }}
+
+    def posts_listing(self, listing, query):
+        posts = self.posts.values()
+        if listing == 'search':
+            q = query.get('q', [''])[0]
+            if q == 'flair:betrayed':
+                posts = [x for x in posts if x['betrayed']]
+            elif q == 'NOT flair:betrayed':
+                posts = [x for x in posts if not x['betrayed']]
+        if listing in ('new', 'rising'):
+            posts.sort(key=lambda x: -x['created'])
+        else:
+            posts.sort(key=lambda x: -self.users[x['author'].lower()]
+                       ['followers'])
+        return [self.post_json(x) for x in posts]
+
+    def comments_listing(self, author=None):
+        if author:
+            user = self.users.get(author.lower())
+            return [self.comment_json(user)] if user else []
+        users = sorted(self.users.values(), key=lambda x: -x['time'])
+        return [self.comment_json(x) for x in users[:1000]]
+
+    def embed(self, author):
+        post = self.circles.get(author.lower())
+        if not post:
+            return None
+        user = self.users[author.lower()]
+        config = {
+            'circle_num_inside': user['followers'],
+            'circle_num_outside': 0,
+            'circle_is_betrayed': post['betrayed'],
+            'user_websocket_url': '%s/_ws/user' % (self.ws_base,),
+            'circle_websocket_url': '%s/_ws/circle/%s' % (self.ws_base,
+                                                          post['id']),
+        }
+        return (
+            u'<html><head><link rel="canonical" '
+            u'href="https://www.reddit.com/user/%s/circle/embed/"/></head>'
+            u'<body><div class="circle-title"><a href="/r/%s/comments/%s/'
+            u'circle/">%s</a></div>'
+            u'<script type="text/javascript" id="config">r.setup(%s);'
+            u'</script></body></html>'
+        ) % (post['author'], SUBREDDIT, post['id'],
+             cgi.escape(post['title'], quote=True), json.dumps(config))
+
+    def push(self, post, betray_rate):
+        """Change a circle as if someone joined (or betrayed) it, and
+        return the changed embed config values."""
+        with self.lock:
+            user = self.users[post['author'].lower()]
+            if not post['betrayed']:
+                if random.random() < betray_rate:
+                    post['betrayed'] = True
+                else:
+                    user['followers'] += 1
+                user['time'] = time.time()
+            return {'circle_num_inside': user['followers'],
+                    'circle_num_outside': 0,
+                    'circle_is_betrayed': post['betrayed']}
+
+def _ws_frame(data):
+    """Encode an unmasked websocket text frame."""
+    if len(data) < 126:
+        header = struct.pack('!BB', 0x81, len(data))
+    elif len(data) < 65536:
+        header = struct.pack('!BBH', 0x81, 126, len(data))
+    else:
+        header = struct.pack('!BBQ', 0x81, 127, len(data))
+    return header + data
+
+def _listing(children, query):
+    after = query.get('after', [None])[0]
+    limit = int(query.get('limit', ['25'])[0])
+    start = 0
+    if after:
+        names = [x['data']['name'] for x in children]
+        start = names.index(after)+1 if after in names else len(children)
+    page = children[start:start+limit]
+    return {'kind': 'Listing', 'data': {
+        'children': page, 'before': None,
+        'after': page[-1]['data']['name']
+                 if page and start+limit < len(children) else None,
+    }}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="Address to listen on.")
+    parser.add_argument('--port', type=int, default=8082,
+                        help="Port to listen on.")
+    parser.add_argument('--db', default='circle.db',
+                        help="Database to serve circles and users from.")
+    parser.add_argument('--rate-limit', type=int, default=600,
+                        help="Requests per client per 10 minutes.")
+    parser.add_argument('--churn', type=float, default=0,
+                        help="Chance of a random follower change per request.")
+    parser.add_argument('--fail-rate', type=float, default=0,
+                        help="Fraction of requests to fail (to test retries).")
+    parser.add_argument('--ws-interval', type=float, default=5,
+                        help="Average seconds between websocket pushes.")
+    parser.add_argument('--ws-betray', type=float, default=0,
+                        help="Chance of a circle being betrayed per push.")
+    parser.add_argument('--ws-drop', type=float, default=0,
+                        help="Chance of dropping a websocket after a push.")
+    args = parser.parse_args()
+
+    standin = Standin(args.db, args.rate_limit, args.churn)
+    standin.ws_base = 'ws://%s:%d' % (args.host, args.port)
+    sr_re = re.compile(r'^r/%s/(top|hot|new|rising|search|comments)$' %
+                       (SUBREDDIT,), re.I)
+
+    class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def _client(self):
+            auth = self.headers.get('Authorization', '')
+            if auth.lower().startswith('bearer token-'):
+                return auth[len('bearer token-'):]
+            if auth.lower().startswith('basic '):
+                return base64.b64decode(auth[6:]).split(':')[0]
+            return 'anonymous'
+
+        def _reply(self, status, body, headers=None,
+                   content_type='application/json'):
+            if not isinstance(body, basestring):
+                body = json.dumps(body)
+            if isinstance(body, unicode):
+                body = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for key, val in (headers or {}).items():
+                self.send_header(key, val)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _websocket(self, post):
+            key = self.headers.get('Sec-WebSocket-Key')
+            if not key:
+                return self._reply(400, {'error': 400})
+            self.close_connection = 1
+            self.send_response(101, 'Switching Protocols')
+            self.send_header('Upgrade', 'websocket')
+            self.send_header('Connection', 'Upgrade')
+            self.send_header('Sec-WebSocket-Accept', base64.b64encode(
+                hashlib.sha1(key + WS_GUID).digest()))
+            self.end_headers()
+            logging.info("Websocket opened for %s", post['author'])
+            try:
+                while True:
+                    time.sleep(random.expovariate(1./args.ws_interval))
+                    update = standin.push(post, args.ws_betray)
+                    self.wfile.write(_ws_frame(json.dumps({
+                        'type': 'circle_update', 'payload': update})))
+                    self.wfile.flush()
+                    if random.random() < args.ws_drop:
+                        logging.info("Dropping websocket for %s",
+                                     post['author'])
+                        return
+            except socket.error:
+                logging.info("Websocket closed for %s", post['author'])
+
+        def _handle(self, method):
+            url = urlparse.urlsplit(self.path)
+            path = url.path.strip('/')
+            query = urlparse.parse_qs(url.query)
+            parts = path.split('/')
+            if parts[:2] == ['_ws', 'circle'] and len(parts) == 3:
+                post = standin.posts.get(parts[2])
+                if not post:
+                    return self._reply(404, {'error': 404})
+                return self._websocket(post)
+            if method == 'POST':
+                length = int(self.headers.get('Content-Length') or 0)
+                query.update(urlparse.parse_qs(self.rfile.read(length)))
+            if path == '_stats':
+                return self._reply(200, dict(standin.requests))
+
+            client = self._client()
+            headers = standin.count(client)
+            if headers is None:
+                return self._reply(429, {'error': 429})
+
+            if path == 'api/v1/access_token':
+                return self._reply(200, {
+                    'access_token': 'token-' + client, 'token_type': 'bearer',
+                    'expires_in': 3600, 'scope': '*'})
+            if random.random() < args.fail_rate:
+                return self._reply(503, {'error': 503}, headers)
+            match = sr_re.match(path)
+            if match:
+                listing = match.group(1).lower()
+                children = standin.comments_listing() \
+                           if listing == 'comments' \
+                           else standin.posts_listing(listing, query)
+                return self._reply(200, _listing(children, query), headers)
+            if len(parts) == 2 and parts[0] == 'comments':
+                post = standin.posts.get(parts[1])
+                if not post:
+                    return self._reply(404, {'error': 404}, headers)
+                return self._reply(200, [
+                    _listing([standin.post_json(post)], {}),
+                    _listing([], {}),
+                ], headers)
+            if path == 'api/info':
+                ids = ','.join(query.get('id', [])).split(',')
+                children = [standin.post_json(standin.posts[x[3:]])
+                            for x in ids if x[3:] in standin.posts]
+                comments = dict((x['data']['name'], x)
+                                for x in standin.comments_listing())
+                children += [comments[x] for x in ids if x in comments]
+                return self._reply(200, _listing(children, {}), headers)
+            if len(parts) == 3 and parts[0] == 'user' and \
+               parts[2] == 'comments':
+                return self._reply(200, _listing(
+                    standin.comments_listing(parts[1]), query), headers)
+            if len(parts) == 4 and parts[0] == 'user' and \
+               parts[2:] == ['circle', 'embed.json']:
+                page = standin.embed(parts[1])
+                if page is None:
+                    return self._reply(404, 'Not found', headers, 'text/html')
+                return self._reply(200, page, headers, 'text/html')
+            if path == 'api/editusertext':
+                thing = query.get('thing_id', [''])[0]
+                standin.edits[thing] = query.get('text', [''])[0]
+                logging.info("Edited %s (%d bytes)", thing,
+                             len(standin.edits[thing]))
+                post = standin.posts.values()[0]
+                return self._reply(200, {'json': {'errors': [], 'data': {
+                    'things': [standin.post_json(post)]}}}, headers)
+            return self._reply(404, {'error': 404}, headers)
+
+        def do_GET(self):
+            self._handle('GET')
+
+        def do_POST(self):
+            self._handle('POST')
+
+        def log_message(self, format, *args):
+            logging.debug("%s %s", self.address_string(), format % args)
+
+    class StandinServer(SocketServer.ThreadingMixIn,
+                        BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = StandinServer((args.host, args.port), StandinHandler)
+    logging.info("Stand-in API listening on %s:%d", args.host, args.port)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()